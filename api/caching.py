@@ -0,0 +1,104 @@
+"""Conditional GET support and server-side caching of serialized responses"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Callable, Hashable, NamedTuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from sqlmodel import Session, select
+
+from database.models.alerts import AlertTrigger
+from database.models.rule_changes import RuleChange
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    last_modified: datetime | None
+    body: bytes
+
+    @classmethod
+    def from_content(cls, content: Any, last_modified: datetime | None = None, etag: str | None = None):
+        body = json.dumps(jsonable_encoder(content)).encode("utf-8")
+        etag = etag or hashlib.sha1(body).hexdigest()
+        return cls(etag=f'"{etag}"', last_modified=last_modified, body=body)
+
+    def to_response(self, request: Request) -> Response:
+        """The cached body, or 304 Not Modified if the client already has it"""
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache"}
+        if self.last_modified is not None:
+            headers["Last-Modified"] = format_datetime(self.last_modified.astimezone(timezone.utc), usegmt=True)
+
+        if is_not_modified(request, self.etag, self.last_modified):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have a one second resolution
+        return last_modified.astimezone().replace(microsecond=0) <= since.astimezone()
+
+    return False
+
+
+class VersionedResponseCache:
+    """Single serialized response, valid as long as the version it was built for"""
+
+    def __init__(self):
+        self._version: Hashable | None = None
+        self._response: CachedResponse | None = None
+
+    def get(self, version: Hashable, build: Callable[[], CachedResponse]) -> CachedResponse:
+        if self._response is None or self._version != version:
+            self._response = build()
+            self._version = version
+        return self._response
+
+    def invalidate(self):
+        self._version = None
+        self._response = None
+
+
+class RuleSetVersion(NamedTuple):
+    rule_version: int
+    trigger_version: int
+    last_modified: datetime | None
+
+
+def read_rule_set_version(session: Session) -> RuleSetVersion:
+    """Version of the monitoring rules including their triggers, from primary key lookups only
+
+    Both tables are append-only, so the timestamps are read from their last rows
+    rather than with `max()`, which would scan the unindexed timestamp columns.
+    """
+    def last(column, table):
+        return select(column).order_by(table.id.desc()).limit(1).scalar_subquery()
+
+    rule_version, rule_changed_at, trigger_version, triggered_at = session.execute(
+        select(
+            last(RuleChange.id, RuleChange),
+            last(RuleChange.changed_at, RuleChange),
+            last(AlertTrigger.id, AlertTrigger),
+            last(AlertTrigger.triggered_at, AlertTrigger),
+        )
+    ).one()
+
+    timestamps = [timestamp for timestamp in (rule_changed_at, triggered_at) if timestamp is not None]
+    return RuleSetVersion(
+        rule_version=rule_version or 0,
+        trigger_version=trigger_version or 0,
+        last_modified=max(timestamps) if timestamps else None,
+    )
@@ -0,0 +1,158 @@
+"""Live feed of alert triggers and finished monitoring runs for server-sent events"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, NamedTuple
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from configuration import Configuration
+from database.db import engine
+from database.models.alerts import AlertTrigger, AlertTriggerRead
+from database.models.monitoring_runs import MonitoringRun, MonitoringRunRead
+from monitoring_service import events
+from monitoring_service.events import MonitoringEvent
+
+logger = logging.getLogger(__name__)
+
+
+class FeedEvent(NamedTuple):
+    """Event as sent to the clients, `id` is the id of the latest trigger at that point"""
+
+    id: int
+    type: str
+    data: dict[str, Any]
+
+    def encode(self) -> str:
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(jsonable_encoder(self.data))}\n\n"
+
+
+class AlertFeed:
+    """Fans monitoring events out to the connected clients
+
+    Events come from the monitoring flow when it runs in this process and from a
+    single database poller for runs in other processes, so the database load does not
+    depend on the number of clients. Clients reconnecting with `Last-Event-ID` get the
+    triggers they missed replayed from the database.
+    """
+
+    def __init__(self):
+        self._subscribers: set[asyncio.Queue] = set()
+        self._last_trigger_id = 0
+        self._last_run_finished_at: datetime | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._poller: asyncio.Task | None = None
+        self._unsubscribe = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._last_trigger_id, self._last_run_finished_at = await run_in_threadpool(self._current_state)
+        self._unsubscribe = events.subscribe(self._on_monitoring_event)
+        self._poller = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+        if self._poller is not None:
+            self._poller.cancel()
+        for queue in list(self._subscribers):
+            self._close(queue)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=Configuration.ALERT_FEED_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def _close(self, queue: asyncio.Queue):
+        """Unsubscribe the queue and end its stream, making room for the end marker if it is full"""
+        self._subscribers.discard(queue)
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    @staticmethod
+    def replay(after_trigger_id: int) -> list[FeedEvent]:
+        """Triggers following the given one, read from the database"""
+        with Session(engine) as session:
+            stmt = (
+                select(AlertTrigger)
+                .where(AlertTrigger.id > after_trigger_id)
+                .order_by(AlertTrigger.id)
+                .limit(Configuration.ALERT_FEED_REPLAY_LIMIT)
+            )
+            return [
+                FeedEvent(trigger.id, "trigger", AlertTriggerRead.from_orm(trigger).dict())
+                for trigger in session.exec(stmt).all()
+            ]
+
+    def _on_monitoring_event(self, event: MonitoringEvent):
+        # called from the thread running the monitoring flow
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: MonitoringEvent):
+        if event.type == "trigger":
+            if event.data["id"] <= self._last_trigger_id:
+                return
+            self._last_trigger_id = event.data["id"]
+
+        elif event.type == "run-finished":
+            finished_at = event.data["finished_at"]
+            if self._last_run_finished_at is not None and finished_at <= self._last_run_finished_at:
+                return
+            self._last_run_finished_at = finished_at
+
+        feed_event = FeedEvent(self._last_trigger_id, event.type, event.data)
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(feed_event)
+            except asyncio.QueueFull:
+                # the client is too slow, it reconnects and catches up via Last-Event-ID
+                self._close(queue)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(Configuration.ALERT_FEED_POLL_SECONDS)
+            try:
+                new_events = await run_in_threadpool(
+                    self._read_new_events, self._last_trigger_id, self._last_run_finished_at
+                )
+            except Exception as exc:
+                logger.error(f"Failed to poll monitoring events: {str(exc)}")
+                continue
+            for event in new_events:
+                self._dispatch(event)
+
+    @staticmethod
+    def _current_state() -> tuple[int, datetime | None]:
+        with Session(engine) as session:
+            last_trigger_id = session.exec(select(func.max(AlertTrigger.id))).one() or 0
+            last_run_finished_at = session.exec(select(func.max(MonitoringRun.finished_at))).one()
+            return last_trigger_id, last_run_finished_at
+
+    @staticmethod
+    def _read_new_events(after_trigger_id: int, after_finished_at: datetime | None) -> list[MonitoringEvent]:
+        with Session(engine) as session:
+            triggers = session.exec(
+                select(AlertTrigger).where(AlertTrigger.id > after_trigger_id).order_by(AlertTrigger.id)
+            ).all()
+            runs_stmt = select(MonitoringRun).where(MonitoringRun.finished_at.is_not(None))
+            if after_finished_at is not None:
+                runs_stmt = runs_stmt.where(MonitoringRun.finished_at > after_finished_at)
+            runs = session.exec(runs_stmt.order_by(MonitoringRun.finished_at)).all()
+
+            return [
+                MonitoringEvent("trigger", AlertTriggerRead.from_orm(trigger).dict()) for trigger in triggers
+            ] + [
+                MonitoringEvent("run-finished", MonitoringRunRead.from_orm(run).dict()) for run in runs
+            ]
+
+
+alert_feed = AlertFeed()
@@ -1,11 +1,25 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Iterator
+
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request, Header, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
 
-from api.schemas import ReadMetricsResponse
+from api.caching import CachedResponse, VersionedResponseCache, read_rule_set_version
+from api.events import alert_feed
+from api.schemas import ReadMetricsResponse, BulkImportResponse, BulkImportError, MetricHistoryResponse, \
+    BacktestRequest, BacktestResponse, BacktestThresholdResult, MetricDistribution
+from configuration import Configuration
 from database.db import create_db_and_tables, engine
 from database.models.alerts import AlertDefinition
-from database.models.monitoring_rules import MonitoringRule, MonitoringRuleRead, MonitoringRuleCreate, MetricType
+from database.models.monitoring_rules import MonitoringRule, MonitoringRuleRead, MonitoringRuleCreate, MetricType, \
+    MonitoringRuleExport
 
 app = FastAPI(name="Acropolis API")
 
@@ -27,6 +41,16 @@ def on_startup():
     create_db_and_tables()
 
 
+@app.on_event("startup")
+async def start_alert_feed():
+    await alert_feed.start()
+
+
+@app.on_event("shutdown")
+async def stop_alert_feed():
+    await alert_feed.stop()
+
+
 def get_session():
     with Session(engine) as session:
         yield session
@@ -42,19 +66,51 @@ async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
+monitoring_rules_cache = VersionedResponseCache()
+
+
 @app.get("/monitoring-rules/", response_model=list[MonitoringRuleRead])
 async def read_monitoring_rules(
-    *, session: Session = Depends(get_session),
+    *, session: Session = Depends(get_session), request: Request,
 ):
-    monitoring_rules = session.exec(select(MonitoringRule)).all()
-    return monitoring_rules
+    """All monitoring rules, served from the cached JSON while the rules and triggers are unchanged"""
+    version = read_rule_set_version(session)
+
+    def build() -> CachedResponse:
+        stmt = select(MonitoringRule).options(
+            selectinload(MonitoringRule.alert_definitions),
+            selectinload(MonitoringRule.alert_triggers),
+        )
+        monitoring_rules = [
+            MonitoringRuleRead.from_orm(monitoring_rule) for monitoring_rule in session.exec(stmt).all()
+        ]
+        return CachedResponse.from_content(
+            monitoring_rules,
+            last_modified=version.last_modified,
+            etag=f"rules-{version.rule_version}-{version.trigger_version}",
+        )
+
+    return monitoring_rules_cache.get(version, build).to_response(request)
+
+
+# the metrics are static
+_metrics_response = CachedResponse.from_content(
+    ReadMetricsResponse(metrics=[metric.value for metric in list(MetricType)])
+)
 
 
 @app.get("/metrics/", response_model=ReadMetricsResponse)
-async def read_metrics():
-    return {
-        "metrics": [metric.value for metric in list(MetricType)]
-    }
+async def read_metrics(request: Request):
+    return _metrics_response.to_response(request)
+
+
+def build_monitoring_rule(monitoring_rule: MonitoringRuleCreate) -> MonitoringRule:
+    db_monitoring_rule = MonitoringRule.from_orm(monitoring_rule)
+    db_monitoring_rule.alert_definitions = [
+        AlertDefinition.from_orm(alert)
+        for alert in monitoring_rule.alert_definitions
+    ]
+    return db_monitoring_rule
 
 
 @app.post("/monitoring-rules/", response_model=MonitoringRuleRead)
@@ -63,13 +119,199 @@ async def create_monitoring_rule(
     session: Session = Depends(get_session),
     monitoring_rule: MonitoringRuleCreate
 ):
-    db_monitoring_rule = MonitoringRule.from_orm(monitoring_rule)
-    db_monitoring_rule.alert_definitions = [
-        AlertDefinition.from_orm(alert)
-        for alert in monitoring_rule.alert_definitions
-    ]
+    db_monitoring_rule = build_monitoring_rule(monitoring_rule)
 
     session.add(db_monitoring_rule)
     session.commit()
+    monitoring_rules_cache.invalidate()
     return db_monitoring_rule
 
+
+async def read_lines(request: Request) -> AsyncIterator[bytes]:
+    """Lines of the request body as they arrive"""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+@app.post("/monitoring-rules/import", response_model=BulkImportResponse)
+async def import_monitoring_rules(
+    *,
+    session: Session = Depends(get_session),
+    request: Request,
+):
+    """Create monitoring rules from an NDJSON body, one `MonitoringRuleCreate` per line
+
+    Lines are validated as they are received and inserted in batched transactions.
+    Invalid lines are skipped and reported by line number.
+    """
+    imported = 0
+    errors = []
+    batch: list[tuple[int, MonitoringRule]] = []
+
+    def insert_batch():
+        nonlocal imported
+        session.add_all(db_monitoring_rule for _, db_monitoring_rule in batch)
+        try:
+            session.commit()
+            imported += len(batch)
+        except SQLAlchemyError as exc:
+            session.rollback()
+            errors.extend(BulkImportError(line=line, error=f"Database error: {str(exc)}") for line, _ in batch)
+        session.expunge_all()
+        batch.clear()
+
+    line_number = 0
+    async for line in read_lines(request):
+        line_number += 1
+        if not line.strip():
+            continue
+
+        try:
+            monitoring_rule = MonitoringRuleCreate.parse_raw(line)
+        except ValidationError as exc:
+            errors.append(BulkImportError(line=line_number, error=str(exc)))
+            continue
+
+        batch.append((line_number, build_monitoring_rule(monitoring_rule)))
+        if len(batch) >= Configuration.BULK_IMPORT_BATCH_SIZE:
+            insert_batch()
+
+    if batch:
+        insert_batch()
+    monitoring_rules_cache.invalidate()
+
+    return BulkImportResponse(imported=imported, errors=errors)
+
+
+@app.get("/monitoring-rules/export")
+async def export_monitoring_rules():
+    """Stream all monitoring rules as NDJSON in the format accepted by the import"""
+
+    def export_lines() -> Iterator[str]:
+        with Session(engine) as session:
+            last_id = 0
+            while True:
+                stmt = (
+                    select(MonitoringRule)
+                    .where(MonitoringRule.id > last_id)
+                    .order_by(MonitoringRule.id)
+                    .limit(Configuration.BULK_EXPORT_BATCH_SIZE)
+                    .options(selectinload(MonitoringRule.alert_definitions))
+                )
+                monitoring_rules = session.exec(stmt).all()
+                if not monitoring_rules:
+                    break
+
+                yield "".join(
+                    MonitoringRuleExport.from_orm(monitoring_rule).json() + "\n"
+                    for monitoring_rule in monitoring_rules
+                )
+                last_id = monitoring_rules[-1].id
+                # keep only one batch in the identity map
+                session.expunge_all()
+
+    return StreamingResponse(export_lines(), media_type="application/x-ndjson")
+
+
+@app.post("/monitoring-rules/backtest", response_model=BacktestResponse)
+def backtest_monitoring_rule(backtest: BacktestRequest):
+    """How often the rule, with its own or each of the given thresholds, would have fired on the archived forecasts"""
+    from monitoring_service.backtest import backtest_rule, compile_candidate
+
+    try:
+        result = backtest_rule(
+            compile_candidate(backtest.rule), backtest.thresholds, backtest.time_from, backtest.time_to
+        )
+    except NotImplementedError:
+        raise HTTPException(status_code=422, detail=f"Area {backtest.rule.area_definition.__root__.type} is not supported")
+
+    return BacktestResponse(
+        forecasts=len(result.evaluated_at),
+        results=[
+            BacktestThresholdResult(
+                threshold=threshold,
+                fire_count=fire_count,
+                fired_at=result.evaluated_at[fired].tolist(),
+            )
+            for threshold, fire_count, fired in zip(result.thresholds, result.fire_counts.tolist(), result.fired)
+        ],
+        distribution=MetricDistribution(**result.distribution()),
+    )
+
+
+@app.get("/metric-history/", response_model=MetricHistoryResponse)
+def read_metric_history(
+    time_from: datetime | None = None,
+    time_to: datetime | None = None,
+    rule_id: list[int] | None = Query(default=None),
+):
+    """Metric values of the given rules (default all) evaluated in the range (default the last 7 days)"""
+    import numpy as np
+
+    from monitoring_service.metric_history import query_metric_values
+
+    time_to = time_to or datetime.now()
+    time_from = time_from or time_to - timedelta(days=7)
+    history = query_metric_values(time_from, time_to, rule_id)
+
+    values = history["value"].astype(object)
+    values[history["value"] != history["value"]] = None  # NaN, rules without data
+    # serialized straight from the columns, validating every row would dominate large ranges
+    return JSONResponse({
+        "run_ids": history["run_id"].tolist(),
+        "rule_ids": history["rule_id"].tolist(),
+        "evaluated_at": np.datetime_as_string(history["evaluated_at"]).tolist(),
+        "values": values.tolist(),
+        "thresholds": history["threshold"].tolist(),
+    })
+
+
+@app.get("/alerts/stream")
+async def stream_alerts(
+    *,
+    request: Request,
+    last_event_id: int | None = Header(default=None),
+):
+    """Server-sent events with new alert triggers and finished monitoring runs
+
+    Event ids are trigger ids, so a client reconnecting with `Last-Event-ID` first
+    receives the triggers it missed.
+    """
+    # subscribe before replaying so nothing falls in between
+    queue = alert_feed.subscribe()
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            last_sent_id = last_event_id
+            if last_event_id is not None:
+                for event in await run_in_threadpool(alert_feed.replay, last_event_id):
+                    yield event.encode()
+                    last_sent_id = event.id
+
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=Configuration.ALERT_FEED_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if event is None:
+                    break
+                if event.type == "trigger" and last_sent_id is not None and event.id <= last_sent_id:
+                    # already replayed
+                    continue
+                yield event.encode()
+        finally:
+            alert_feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
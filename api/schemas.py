@@ -1,5 +1,60 @@
+from datetime import datetime
+
 from pydantic import BaseModel
 
+from database.models.monitoring_rules import MonitoringRuleCreate
+
 
 class ReadMetricsResponse(BaseModel):
-    metrics: list[str]
\ No newline at end of file
+    metrics: list[str]
+
+
+class BulkImportError(BaseModel):
+    line: int
+    error: str
+
+
+class BulkImportResponse(BaseModel):
+    imported: int
+    errors: list[BulkImportError]
+
+
+class MetricHistoryResponse(BaseModel):
+    """Column per field, row `i` of every column is one evaluation of a rule"""
+
+    run_ids: list[int]
+    rule_ids: list[int]
+    evaluated_at: list[datetime]
+    values: list[float | None]
+    thresholds: list[float]
+
+
+class BacktestRequest(BaseModel):
+    rule: MonitoringRuleCreate
+    # thresholds to try instead of the rule's value
+    thresholds: list[float] | None = None
+    time_from: datetime | None = None
+    time_to: datetime | None = None
+
+
+class BacktestThresholdResult(BaseModel):
+    threshold: float
+    # archived forecasts the rule would have fired on, not monitoring runs
+    fire_count: int
+    fired_at: list[datetime]
+
+
+class MetricDistribution(BaseModel):
+    count: int
+    min: float | None = None
+    max: float | None = None
+    mean: float | None = None
+    percentiles: dict[int, float] = {}
+    histogram_counts: list[int] = []
+    histogram_edges: list[float] = []
+
+
+class BacktestResponse(BaseModel):
+    forecasts: int
+    results: list[BacktestThresholdResult]
+    distribution: MetricDistribution
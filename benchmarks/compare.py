@@ -0,0 +1,50 @@
+"""Compare two `benchmarks.run_flow` result files
+
+    python -m benchmarks.compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import json
+from pathlib import Path
+
+
+def load(path: Path) -> dict:
+    return json.loads(path.read_text())
+
+
+def flatten(metrics: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat |= flatten(value, prefix=f"{name}.")
+        elif isinstance(value, list):
+            flat[name] = sum(value) / len(value) if value else 0.0
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("candidate", type=Path)
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline["parameters"] != candidate["parameters"]:
+        print("Warning: the runs used different parameters")
+        for key in sorted(set(baseline["parameters"]) | set(candidate["parameters"])):
+            old, new = baseline["parameters"].get(key), candidate["parameters"].get(key)
+            if old != new:
+                print(f"  {key}: {old} -> {new}")
+
+    old_metrics, new_metrics = flatten(baseline["metrics"]), flatten(candidate["metrics"])
+    print(f"{'metric':<32} {baseline['revision']['commit']:>14} {candidate['revision']['commit']:>14} {'change':>9}")
+    for name in sorted(set(old_metrics) & set(new_metrics)):
+        old, new = old_metrics[name], new_metrics[name]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:<32} {old:>14.3f} {new:>14.3f} {change:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Local stand-in for the EDR weather server used by the benchmarks
+
+Serves synthetic CoverageJSON for `/collections/<collection>/<query_type>` with
+configurable response size, injected latency and failure rate, and counts the
+requests it has served.
+
+    python -m benchmarks.edr_stub --port 8765 --latency-ms 150
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+from benchmarks.synthetic import synthetic_coverage
+
+
+class EDRStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        *,
+        points: int = 16,
+        hours: int = 49,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(address, _EDRStubHandler)
+        self.points = points
+        self.hours = hours
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_delay(self) -> tuple[float, bool]:
+        """Delay in seconds for the next request and whether it should fail"""
+        with self._lock:
+            self.request_count += 1
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.error_count += 1
+        return max(0.0, self.latency_ms + jitter) / 1000, fail
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="edr-stub", daemon=True)
+        thread.start()
+        return thread
+
+
+class _EDRStubHandler(BaseHTTPRequestHandler):
+    server: EDRStubServer
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        delay, fail = self.server.next_delay()
+        time.sleep(delay)
+
+        if fail:
+            self._send_json(503, {"code": "503", "description": "Injected failure"})
+            return
+
+        if len(parts) != 3 or parts[0] != "collections":
+            self._send_json(404, {"code": "404", "description": f"Unknown resource {url.path}"})
+            return
+
+        _, collection, query_type = parts
+        params = dict(parse_qsl(url.query))
+        if "parameter-name" not in params:
+            self._send_json(400, {"code": "400", "description": "Missing parameter-name"})
+            return
+
+        coverage = synthetic_coverage(
+            collection=collection,
+            query_type=query_type,
+            params=params,
+            points=self.server.points,
+            hours=self.server.hours,
+        )
+        self._send_json(200, coverage)
+
+    def _send_json(self, status: int, content: dict):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server._lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--points", type=int, default=16, help="grid points per radius query")
+    parser.add_argument("--hours", type=int, default=49, help="forecast length in hours")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = EDRStubServer(
+        (args.host, args.port),
+        points=args.points,
+        hours=args.hours,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+    )
+    print(f"Serving synthetic EDR data on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Cold start benchmark of the entry points based on `python -X importtime`
+
+    python -m benchmarks.import_time --repeat 5
+    python -m benchmarks.import_time --module runner --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent
+ENTRY_POINTS = ["runner", "warmup", "api.main"]
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module loaded by importing `module`"""
+    # run from a scratch directory so the entry points do not touch the real data
+    with tempfile.TemporaryDirectory() as cwd:
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=cwd,
+            env=os.environ | {"PYTHONPATH": str(ROOT_DIR)},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", action="append", help="entry point(s) to measure")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports")
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.module or ENTRY_POINTS:
+        samples = [import_times(module) for _ in range(args.repeat)]
+        totals = [sample[module] for sample in samples]
+        results[module] = {
+            "median_ms": statistics.median(totals) / 1000,
+            "min_ms": min(totals) / 1000,
+            "modules_loaded": len(samples[-1]),
+        }
+        print(f"{module:<12} median {results[module]['median_ms']:8.1f} ms  "
+              f"min {results[module]['min_ms']:8.1f} ms  {results[module]['modules_loaded']} modules")
+
+        if args.top:
+            top_level = {name: time for name, time in samples[-1].items() if "." not in name}
+            for name, time in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+                print(f"    {name:<30} {time / 1000:8.1f} ms")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
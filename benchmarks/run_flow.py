@@ -0,0 +1,220 @@
+"""End-to-end benchmark of `run_monitoring_flow` against the local EDR stub
+
+Seeds a database with N synthetic monitoring rules, serves the weather data from
+`benchmarks.edr_stub` and measures run latency percentiles, rule throughput,
+upstream traffic and peak memory. The results are written as JSON tagged with the
+current commit so runs can be compared with `benchmarks.compare`.
+
+    python -m benchmarks.run_flow --rules 500 --areas 20 --latency-ms 50 --repeat 5
+
+By default everything runs in a temporary directory so `app.db` and the real
+weather cache stay untouched; pass `--database app.db` to seed the real database.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.edr_stub import EDRStubServer
+from benchmarks.synthetic import synthetic_rules
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def git_revision() -> dict:
+    def git(*args: str) -> str:
+        try:
+            return subprocess.run(
+                ["git", *args], capture_output=True, text=True, check=True,
+                cwd=Path(__file__).parent,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD") or "unknown",
+        "subject": git("log", "-1", "--format=%s"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def configure_environment(workdir: Path, database: Path | None, base_url: str) -> None:
+    """Point the configuration at the stub and the scratch directories
+
+    Must happen before `configuration` / `database.db` are imported.
+    """
+    db_file = database.resolve() if database else workdir / "bench.db"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_file}"
+    os.environ["DATABASE_ECHO"] = "0"
+    os.environ["WEATHER_CACHE_DIR"] = str(workdir / "weather_cache")
+    os.environ["METRIC_HISTORY_DIR"] = str(workdir / "metric_history")
+    os.environ["FORECAST_ARCHIVE_DIR"] = str(workdir / "forecast_archive")
+    os.environ["RULE_REGISTRY_SNAPSHOT_FILE"] = str(workdir / "rule_registry.pickle")
+    os.environ["EDR_BASE_URL"] = base_url
+    os.environ.setdefault("EDR_RATE_LIMIT_PER_SECOND", "1000")
+    os.environ.setdefault("EDR_RATE_LIMIT_BURST", "1000")
+
+
+def seed_rules(count: int, areas: int, seed: int, replace: bool, point_share: float = 0.0) -> int:
+    from sqlalchemy import delete
+    from sqlmodel import Session
+
+    from database.db import create_db_and_tables, engine
+    from database.models.monitoring_rules import MonitoringRule
+
+    create_db_and_tables()
+    with Session(engine) as session:
+        if replace:
+            session.execute(delete(MonitoringRule))
+        session.add_all(MonitoringRule(**rule) for rule in synthetic_rules(count, areas, seed, point_share))
+        session.commit()
+    return count
+
+
+def clear_cache() -> None:
+    from configuration import Configuration
+
+    shutil.rmtree(Configuration.WEATHER_CACHE_DIR, ignore_errors=True)
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    values = np.asarray(samples, dtype=float)
+    return {
+        "min": float(values.min()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+    }
+
+
+def run_benchmark(args: argparse.Namespace, server: EDRStubServer) -> dict:
+    from monitoring_service import metrics
+    from monitoring_service.flow import run_monitoring_flow
+    from monitoring_service.prefetch import run_prefetch
+    from monitoring_service.utils import wait_for_revalidation
+
+    run_seconds = []
+    traced_peaks = []
+    upstream_requests = []
+
+    for i in range(args.repeat):
+        if not args.warm_cache or i == 0:
+            clear_cache()
+
+        if args.prefetch:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                run_prefetch()
+
+        requests_before = server.stats()["requests"]
+        if args.trace_memory:
+            tracemalloc.start()
+
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                start = time.perf_counter()
+                run_monitoring_flow()
+                elapsed = time.perf_counter() - start
+                # background cache refreshes belong to this run's upstream traffic
+                wait_for_revalidation()
+
+        if args.trace_memory:
+            traced_peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        run_seconds.append(elapsed)
+        upstream_requests.append(server.stats()["requests"] - requests_before)
+        print(f"run {i + 1}/{args.repeat}: {elapsed:.3f} s, {upstream_requests[-1]} upstream requests",
+              file=sys.stderr)
+
+    result = {
+        "run_seconds": percentiles(run_seconds),
+        "rules_per_second": args.rules / float(np.median(run_seconds)),
+        "upstream_requests_per_run": upstream_requests,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stub": server.stats(),
+        "counters": metrics.snapshot(),
+    }
+    if traced_peaks:
+        result["peak_traced_bytes"] = max(traced_peaks)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=200, help="number of synthetic rules")
+    parser.add_argument("--areas", type=int, default=20, help="number of distinct rule areas")
+    parser.add_argument("--point-share", type=float, default=0.0, help="share of point areas (position queries)")
+    parser.add_argument("--points", type=int, default=16, help="grid points per radius response")
+    parser.add_argument("--hours", type=int, default=49, help="forecast length in hours")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="injected upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--repeat", type=int, default=3, help="number of measured runs")
+    parser.add_argument("--warm-cache", action="store_true", help="keep the weather cache between runs")
+    parser.add_argument("--prefetch", action="store_true", help="warm up the cache before each run")
+    parser.add_argument("--trace-memory", action="store_true", help="also report tracemalloc peaks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", type=Path, help="seed this SQLite file instead of a scratch one")
+    parser.add_argument("--workdir", type=Path, help="scratch directory (default: temporary)")
+    parser.add_argument("--output", type=Path, help="result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--verbose", action="store_true", help="show the monitoring flow output")
+    args = parser.parse_args()
+
+    server = EDRStubServer(
+        ("127.0.0.1", 0),
+        points=args.points,
+        hours=args.hours,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    server.start()
+
+    # fetches still running past a run deadline may write into it while it is removed
+    with tempfile.TemporaryDirectory(prefix="acropolis-bench-", ignore_cleanup_errors=True) as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        configure_environment(workdir, args.database, server.base_url)
+
+        seed_rules(args.rules, args.areas, args.seed, replace=args.database is None, point_share=args.point_share)
+        metrics = run_benchmark(args, server)
+
+    server.shutdown()
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {
+            key: vars(args)[key]
+            for key in ("rules", "areas", "point_share", "points", "hours", "latency_ms", "jitter_ms",
+                        "error_rate", "repeat", "warm_cache", "prefetch", "seed")
+        },
+        "metrics": metrics,
+    }
+
+    output = args.output or RESULTS_DIR / f"{revision['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(json.dumps(report["metrics"], indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Local check and timing of sharded monitoring runs against the EDR stub
+
+Seeds a scratch SQLite database, evaluates the rules once in a single process and
+once sharded over several worker processes, and checks both runs triggered the same
+rules with every shard completed exactly once. `--crash` adds a worker which claims
+a shard and dies without completing it, so the others have to take it over.
+
+    python -m benchmarks.sharded_run --rules 400 --shards 8 --workers 4 --crash
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.edr_stub import EDRStubServer
+from benchmarks.run_flow import configure_environment, seed_rules
+
+
+def crashing_worker(monitoring_run_id: int) -> None:
+    from sqlmodel import Session
+
+    from database.db import engine
+    from monitoring_service.sharding import claim_lease
+
+    with Session(engine) as session:
+        lease = claim_lease(session, monitoring_run_id, "crashing-worker")
+        print(f"crashing worker claimed shard {lease.shard if lease else None}", file=sys.stderr)
+    os._exit(1)
+
+
+def triggered_rule_ids(monitoring_run_id: int) -> Counter:
+    from sqlmodel import Session, select
+
+    from database.db import engine
+    from database.models.alerts import AlertTrigger
+
+    with Session(engine) as session:
+        return Counter(session.exec(
+            select(AlertTrigger.monitoring_rule_id).where(AlertTrigger.monitoring_run_id == monitoring_run_id)
+        ).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=200)
+    parser.add_argument("--areas", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--crash", action="store_true", help="add a worker dying with a claimed shard")
+    parser.add_argument("--lease-ttl", type=float, default=2.0, help="lease duration in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = EDRStubServer(("127.0.0.1", 0), latency_ms=args.latency_ms, seed=args.seed)
+    server.start()
+
+    with tempfile.TemporaryDirectory(prefix="acropolis-shards-") as tmp:
+        configure_environment(Path(tmp), None, server.base_url)
+        os.environ["RUN_LEASE_TTL_SECONDS"] = str(args.lease_ttl)
+        os.environ["RUN_LEASE_POLL_SECONDS"] = str(args.lease_ttl / 4)
+        seed_rules(args.rules, args.areas, args.seed, replace=True)
+
+        from monitoring_service.flow import run_monitoring_flow
+        from monitoring_service.sharding import run_sharded_flow, start_sharded_run
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            single_run = run_monitoring_flow()
+            single_seconds = time.perf_counter() - start
+
+            if args.crash:
+                # a separate run shows the takeover, the crash leaves one shard behind
+                crashed_run = start_sharded_run(args.shards)
+                process = multiprocessing.get_context("spawn").Process(
+                    target=crashing_worker, args=(crashed_run.id,)
+                )
+                process.start()
+                process.join()
+
+            start = time.perf_counter()
+            sharded_run = run_sharded_flow(args.shards, args.workers)
+            sharded_seconds = time.perf_counter() - start
+
+            if args.crash:
+                from monitoring_service.sharding import run_shard_worker
+                start = time.perf_counter()
+                run_shard_worker(crashed_run.id)
+                takeover_seconds = time.perf_counter() - start
+
+        print(f"single process: {single_seconds:.3f} s, "
+              f"{args.shards} shards on {args.workers} workers: {sharded_seconds:.3f} s", file=sys.stderr)
+
+        expected = triggered_rule_ids(single_run.id)
+        runs = [sharded_run] + ([crashed_run] if args.crash else [])
+        ok = True
+        for run in runs:
+            actual = triggered_rule_ids(run.id)
+            duplicates = [rule_id for rule_id, count in actual.items() if count > 1]
+            same = set(actual) == set(expected)
+            ok &= same and not duplicates
+            print(f"run {run.id}: {sum(actual.values())} triggers, same rules as single process: {same}, "
+                  f"duplicates: {len(duplicates)}", file=sys.stderr)
+        if args.crash:
+            print(f"takeover of the crashed shard: {takeover_seconds:.3f} s", file=sys.stderr)
+
+    server.shutdown()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Deterministic synthetic CoverageJSON responses and monitoring rules"""
+import random
+import re
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from database.models.monitoring_rules import MetricType, LogicalOperator, EvaluationMode
+
+# (mean, spread) of the generated values per EDR parameter
+PARAMETER_RANGES = {
+    "temperature": (283.15, 8.0),  # K
+    "relative-humidity": (70.0, 15.0),  # %
+    "precipitation": (70.0, 15.0),  # see RelativeHumidityDataProvider
+    "u-component-of-wind": (0.0, 6.0),  # m/s
+    "v-component-of-wind": (0.0, 6.0),  # m/s
+}
+PRECIPITATION_RANGE = (0.4, 0.6)  # kg/m²
+
+# (min, max) thresholds of the generated rules per metric
+METRIC_THRESHOLDS = {
+    MetricType.Temperature: (-5.0, 30.0),
+    MetricType.WindSpeed: (2.0, 20.0),
+    MetricType.RelativeHumidity: (40.0, 100.0),
+    MetricType.Precipitation: (0.5, 10.0),
+}
+
+BRATISLAVA = (48.148598, 17.107748)
+
+_POINT_RE = re.compile(r"POINT\(\s*([-\d.]+)\s+([-\d.]+)\s*\)")
+
+
+def forecast_times(hours: int, start: datetime | None = None) -> list[str]:
+    """Hourly time axis starting at the last full hour, as served by the EDR API"""
+    start = start or datetime.now().replace(minute=0, second=0, microsecond=0)
+    return [(start + timedelta(hours=h)).isoformat() + "Z" for h in range(hours)]
+
+
+def parse_coords(coords: str) -> list[tuple[float, float]]:
+    """Parse `POINT(x y)` / `MULTIPOINT((x y), ...)` WKT into (long, lat) pairs"""
+    if coords.startswith("MULTIPOINT"):
+        pairs = re.findall(r"\(?\s*([-\d.]+)\s+([-\d.]+)\s*\)?", coords[len("MULTIPOINT"):])
+    else:
+        pairs = _POINT_RE.findall(coords)
+    return [(float(x), float(y)) for x, y in pairs]
+
+
+def position_series(collection: str, parameter_name: str, long: float, lat: float, hours: int) -> np.ndarray:
+    """Hourly values of the parameter at the position"""
+    seed = zlib.crc32(f"{collection}|{parameter_name}|{long:.6f}|{lat:.6f}".encode())
+    rng = np.random.default_rng(seed)
+
+    if parameter_name.startswith("total-precipitation"):
+        mean, spread = PRECIPITATION_RANGE
+        return np.clip(rng.normal(mean, spread, size=hours), 0, None)
+
+    mean, spread = PARAMETER_RANGES.get(parameter_name, (0.0, 1.0))
+    trend = np.sin(np.linspace(0, 2 * np.pi, hours)) * spread
+    return mean + trend + rng.normal(0, spread / 4, size=hours)
+
+
+def synthetic_coverage(
+    *,
+    collection: str,
+    query_type: str,
+    params: dict[str, str],
+    points: int,
+    hours: int,
+) -> dict:
+    """Build a CoverageJSON `Coverage` with a (hours, points) range for the queried parameter
+
+    The series of each position only depends on the collection, the parameter and the
+    position, so repeated requests and repeated benchmark runs see identical data, and
+    a point gets the same forecast whether requested alone or in a MULTIPOINT batch.
+    """
+    parameter_name = params["parameter-name"]
+    coords = parse_coords(params.get("coords", ""))
+    if not coords:
+        coords = [(BRATISLAVA[1], BRATISLAVA[0])]
+
+    if query_type == "position":
+        # one value series per requested position
+        positions = coords
+    else:
+        # a small grid around the centre of the radius query
+        long, lat = coords[0]
+        side = int(np.ceil(np.sqrt(points)))
+        positions = [
+            (long + 0.02 * (i % side - side // 2), lat + 0.02 * (i // side - side // 2))
+            for i in range(points)
+        ]
+
+    values = np.column_stack([
+        position_series(collection, parameter_name, long, lat, hours) for long, lat in positions
+    ])
+
+    return {
+        "type": "Coverage",
+        "domain": {
+            "type": "Domain",
+            "domainType": "MultiPointSeries",
+            "axes": {
+                "t": {"values": forecast_times(hours)},
+                "composite": {
+                    "dataType": "tuple",
+                    "coordinates": ["x", "y", "z"],
+                    "values": [[x, y, 2] for x, y in positions],
+                },
+            },
+        },
+        "parameters": {parameter_name: {"type": "Parameter"}},
+        "ranges": {
+            parameter_name: {
+                "type": "NdArray",
+                "dataType": "float",
+                "axisNames": ["t", "composite"],
+                "shape": [hours, len(positions)],
+                "values": values.round(3).ravel().tolist(),
+            }
+        },
+    }
+
+
+def synthetic_rules(count: int, areas: int, seed: int = 0, point_share: float = 0.0) -> list[dict]:
+    """Generate `count` monitoring rule payloads spread over `areas` distinct areas
+
+    `point_share` of the areas are points (radius 0), evaluated with position queries.
+    """
+    rng = random.Random(seed)
+
+    area_definitions = [
+        {
+            "type": "POINT-RADIUS-AREA",
+            "lat": f"{BRATISLAVA[0] + rng.uniform(-0.1, 0.1):.6f}",
+            "long": f"{BRATISLAVA[1] + rng.uniform(-0.1, 0.1):.6f}",
+            "radius": rng.choice([1, 2, 5, 10]),
+            "radius_unit": "KM",
+        }
+        for _ in range(max(1, areas))
+    ]
+    for area_definition in area_definitions[:round(len(area_definitions) * point_share)]:
+        area_definition["radius"] = 0
+    operators = [LogicalOperator.LTE, LogicalOperator.LT, LogicalOperator.GTE, LogicalOperator.GT]
+
+    rules = []
+    for i in range(count):
+        metric = rng.choice(list(MetricType))
+        low, high = METRIC_THRESHOLDS[metric]
+        time_unit = rng.choice(["HOUR", "HOUR", "HOUR", "DAY"])
+        rules.append({
+            "title": f"Synthetic rule #{i}",
+            "metric": metric,
+            "logical_operator": rng.choice(operators),
+            "evaluation_mode": rng.choice(list(EvaluationMode)),
+            "value": round(rng.uniform(low, high), 1),
+            "area_definition": rng.choice(area_definitions),
+            "time_window": {
+                "time_unit": time_unit,
+                "value": rng.randint(1, 6) if time_unit == "HOUR" else rng.randint(1, 2),
+            },
+        })
+    return rules
@@ -6,18 +6,84 @@ from dotenv import load_dotenv
 BASE_DIR = Path.cwd()
 load_dotenv(BASE_DIR / ".env")
 
-print(BASE_DIR)
-
 
 def path_to(*parts: str) -> Path:
+    # directories are created on first write (see `safe_open`), not at import time
     all_parts = [*parts]
-    path = Path(BASE_DIR.parent).joinpath(*all_parts)
-    path.mkdir(parents=True, exist_ok=True)
-    return path
+    return Path(BASE_DIR.parent).joinpath(*all_parts)
 
 
 class Configuration:
-    WEATHER_CACHE_DIR = path_to("data", "weather_cache")
+    WEATHER_CACHE_DIR = (
+        Path(os.environ["WEATHER_CACHE_DIR"]) if "WEATHER_CACHE_DIR" in os.environ
+        else path_to("data", "weather_cache")
+    )
+
+    # forecasts younger than the max age are fresh, stale ones are served while refreshed
+    WEATHER_CACHE_MAX_AGE_SECONDS = float(os.getenv("WEATHER_CACHE_MAX_AGE_SECONDS", "3600"))
+    WEATHER_CACHE_STALE_BUDGET_SECONDS = float(os.getenv("WEATHER_CACHE_STALE_BUDGET_SECONDS", "21600"))
+    WEATHER_CACHE_REVALIDATION_WORKERS = int(os.getenv("WEATHER_CACHE_REVALIDATION_WORKERS", "4"))
+
+    # compiled monitoring rules shared by the processes of consecutive runs
+    RULE_REGISTRY_SNAPSHOT_FILE = (
+        Path(os.environ["RULE_REGISTRY_SNAPSHOT_FILE"]) if "RULE_REGISTRY_SNAPSHOT_FILE" in os.environ
+        else path_to("data", "rule_registry.pickle")
+    )
+
+    METRIC_HISTORY_DIR = (
+        Path(os.environ["METRIC_HISTORY_DIR"]) if "METRIC_HISTORY_DIR" in os.environ
+        else path_to("data", "metric_history")
+    )
+
+    # every fetched forecast is also archived for backtesting
+    FORECAST_ARCHIVE_ENABLED = os.getenv("FORECAST_ARCHIVE_ENABLED", "1") == "1"
+    FORECAST_ARCHIVE_DIR = (
+        Path(os.environ["FORECAST_ARCHIVE_DIR"]) if "FORECAST_ARCHIVE_DIR" in os.environ
+        else path_to("data", "forecast_archive")
+    )
+    # snapshots fetched longer ago are pruned, 0 keeps them forever
+    FORECAST_ARCHIVE_RETENTION_DAYS = float(os.getenv("FORECAST_ARCHIVE_RETENTION_DAYS", "90"))
+
+    PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "8"))
+
+    EDR_BASE_URL = os.getenv("EDR_BASE_URL", "https://climathon.iblsoft.com/data/icon-de/edr")
+    EDR_TIMEOUT_SECONDS = float(os.getenv("EDR_TIMEOUT_SECONDS", "10"))
+    EDR_RATE_LIMIT_PER_SECOND = float(os.getenv("EDR_RATE_LIMIT_PER_SECOND", "10"))
+    EDR_RATE_LIMIT_BURST = float(os.getenv("EDR_RATE_LIMIT_BURST", "20"))
+    EDR_MAX_RETRIES = int(os.getenv("EDR_MAX_RETRIES", "3"))
+    EDR_BACKOFF_BASE_SECONDS = float(os.getenv("EDR_BACKOFF_BASE_SECONDS", "0.5"))
+    EDR_BACKOFF_MAX_SECONDS = float(os.getenv("EDR_BACKOFF_MAX_SECONDS", "8"))
+    EDR_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("EDR_CIRCUIT_FAILURE_THRESHOLD", "5"))
+    EDR_CIRCUIT_RESET_SECONDS = float(os.getenv("EDR_CIRCUIT_RESET_SECONDS", "60"))
+
+    # positions per MULTIPOINT request, bounded by the URL length the server accepts
+    EDR_POSITION_BATCH_SIZE = int(os.getenv("EDR_POSITION_BATCH_SIZE", "50"))
+
+    BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "500"))
+    BULK_EXPORT_BATCH_SIZE = int(os.getenv("BULK_EXPORT_BATCH_SIZE", "500"))
+
+    # runs stop dispatching at the deadline (0 disables it), the remaining rules are deferred
+    RUN_DEADLINE_SECONDS = float(os.getenv("RUN_DEADLINE_SECONDS", "0"))
+    DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+    # rules of more severe metrics are evaluated first, e.g. "PRECIPITATION=3,WIND-SPEED=2"
+    RULE_METRIC_PRIORITIES = {
+        metric: int(priority)
+        for metric, priority in (
+            item.split("=") for item in os.getenv(
+                "RULE_METRIC_PRIORITIES", "PRECIPITATION=3,WIND-SPEED=2,TEMPERATURE=1,RELATIVE-HUMIDITY=0"
+            ).split(",")
+        )
+    }
+
+    # distributed monitoring runs
+    RUN_LEASE_TTL_SECONDS = float(os.getenv("RUN_LEASE_TTL_SECONDS", "60"))
+    RUN_LEASE_POLL_SECONDS = float(os.getenv("RUN_LEASE_POLL_SECONDS", "2"))
+
+    # live alert feed of the API
+    ALERT_FEED_POLL_SECONDS = float(os.getenv("ALERT_FEED_POLL_SECONDS", "2"))
+    ALERT_FEED_KEEPALIVE_SECONDS = float(os.getenv("ALERT_FEED_KEEPALIVE_SECONDS", "15"))
+    ALERT_FEED_QUEUE_SIZE = int(os.getenv("ALERT_FEED_QUEUE_SIZE", "1000"))
+    ALERT_FEED_REPLAY_LIMIT = int(os.getenv("ALERT_FEED_REPLAY_LIMIT", "1000"))
 
     SERVICE_EMAIL_SERVER = "mail.hostmaster.sk"
     SERVICE_EMAIL_PORT_TLS = "587"
@@ -1,16 +1,15 @@
 import json
+import os
 from decimal import Decimal
 from enum import Enum
 from pathlib import Path
 
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlmodel import SQLModel
 
 db_file = Path.cwd() / "app.db"
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///" + str(db_file)
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///" + str(db_file))
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -37,14 +36,17 @@ def dumps(obj):
 
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo=True,
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo=os.getenv("DATABASE_ECHO", "1") == "1",
     json_serializer=dumps
 )
 
 
 def create_db_and_tables():
     from database.models.alerts import AlertDefinition
+    from database.models.deferred_rules import DeferredRule
     from database.models.monitoring_rules import MonitoringRule
+    from database.models.rule_changes import RuleChange
+    from database.models.run_leases import RunLease
 
     SQLModel.metadata.create_all(engine)
 
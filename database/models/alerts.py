@@ -38,6 +38,12 @@ class AlertTriggerBase(SQLModel):
     actual_value: float
 
 
+class AlertTriggerRead(AlertTriggerBase):
+    id: int
+    monitoring_rule_id: int | None
+    monitoring_run_id: int | None
+
+
 class AlertTrigger(AlertTriggerBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     monitoring_rule_id: int | None = Field(default=None, foreign_key="monitoringrule.id")
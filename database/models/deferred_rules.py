@@ -0,0 +1,17 @@
+from typing import Optional
+
+from sqlmodel import SQLModel, Field, Relationship
+
+
+class DeferredRule(SQLModel, table=True):
+    """Rule a monitoring run did not get to before its deadline, the next run evaluates it first"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    monitoring_run_id: int = Field(foreign_key="monitoringrun.id", index=True)
+    monitoring_run: Optional["MonitoringRun"] = Relationship(back_populates="deferred_rules")
+    # no foreign key, the rule may be deleted before the next run
+    monitoring_rule_id: int
+
+
+from database.models.monitoring_runs import MonitoringRun
+DeferredRule.update_forward_refs()
@@ -71,6 +71,10 @@ class MonitoringRuleCreate(MonitoringRuleBase):
     alert_definitions: list["AlertDefinitionCreate"]
 
 
+class MonitoringRuleExport(MonitoringRuleCreate):
+    id: int
+
+
 class MonitoringRuleRead(MonitoringRuleBase):
     id: int
     alert_definitions: list["AlertDefinitionRead"]
@@ -86,6 +90,8 @@ class MonitoringRule(MonitoringRuleBase, table=True):
 
 
 from database.models.alerts import AlertDefinition, AlertDefinitionCreate, AlertDefinitionRead, AlertTrigger
+from database.models.rule_changes import RuleChange
 MonitoringRuleCreate.update_forward_refs()
+MonitoringRuleExport.update_forward_refs()
 MonitoringRuleRead.update_forward_refs()
 MonitoringRule.update_forward_refs()
@@ -4,12 +4,21 @@ from typing import Optional
 from sqlmodel import SQLModel, Field, Relationship
 
 
-class MonitoringRun(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+class MonitoringRunBase(SQLModel):
     started_at: datetime
     finished_at: datetime | None = Field(default=None)
+
+
+class MonitoringRunRead(MonitoringRunBase):
+    id: int
+
+
+class MonitoringRun(MonitoringRunBase, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
     alert_triggers: list["AlertTrigger"] = Relationship(back_populates="monitoring_run")
+    deferred_rules: list["DeferredRule"] = Relationship(back_populates="monitoring_run")
 
 
 from database.models.alerts import AlertTrigger
+from database.models.deferred_rules import DeferredRule
 MonitoringRun.update_forward_refs()
@@ -0,0 +1,38 @@
+from datetime import datetime
+from itertools import chain
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlmodel import SQLModel, Field
+
+
+class RuleChange(SQLModel, table=True):
+    """Append-only log of monitoring rule writes, its last id is the rule-set version"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    monitoring_rule_id: int = Field(index=True)
+    changed_at: datetime
+
+
+@event.listens_for(Session, "after_flush")
+def record_rule_changes(session: Session, flush_context) -> None:
+    from database.models.alerts import AlertDefinition
+    from database.models.monitoring_rules import MonitoringRule
+
+    rule_ids = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, MonitoringRule):
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+                # e.g. only a trigger was appended to the rule
+                continue
+            rule_ids.add(obj.id)
+        elif isinstance(obj, AlertDefinition) and obj.monitoring_rule_id is not None:
+            rule_ids.add(obj.monitoring_rule_id)
+
+    if rule_ids:
+        changed_at = datetime.now()
+        session.connection().execute(
+            RuleChange.__table__.insert(),
+            [{"monitoring_rule_id": rule_id, "changed_at": changed_at} for rule_id in sorted(rule_ids)],
+        )
@@ -0,0 +1,16 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlmodel import SQLModel, Field
+
+
+class RunLease(SQLModel, table=True):
+    """Claim of one rule shard of a distributed monitoring run by a worker"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    monitoring_run_id: int = Field(foreign_key="monitoringrun.id", index=True)
+    shard: int
+    shard_count: int
+    worker_id: str | None = Field(default=None)
+    expires_at: datetime | None = Field(default=None)
+    completed_at: datetime | None = Field(default=None)
@@ -1,9 +1,15 @@
 from configuration import Configuration
-from database.models.alerts import AlertTrigger, AlertType
-from monitoring_service.emails import EmailClient, EmailMessage
+from database.models.alerts import AlertType
+from monitoring_service.rule_registry import CompiledRule
 
 
-def send_alert_notifications(triggers: list[AlertTrigger]) -> None:
+def send_alert_notifications(triggered_rules: list[CompiledRule]) -> None:
+    if not triggered_rules:
+        return
+
+    # the email stack is only needed once something triggered
+    from monitoring_service.emails import EmailClient, EmailMessage
+
     email_client = EmailClient(
         smtp_server=Configuration.SERVICE_EMAIL_SERVER,
         smtp_port=Configuration.SERVICE_EMAIL_PORT_TLS,
@@ -11,17 +17,17 @@ def send_alert_notifications(triggers: list[AlertTrigger]) -> None:
         password=Configuration.SERVICE_EMAIL_PASSWORD,
     )
 
-    for trigger in triggers:
+    for rule in triggered_rules:
         alerts = [
             # rest to be implemented
-            alert for alert in trigger.monitoring_rule.alert_definitions
+            alert for alert in rule.alert_definitions
             if alert.alert_type == AlertType.Email
         ]
         for alert in alerts:
             message = EmailMessage(
                 sender=Configuration.SERVICE_EMAIL_ADDRESS,
                 recipients=[alert.contact_info],
-                subject=f"Alert: {trigger.monitoring_rule.title}"
+                subject=f"Alert: {rule.title}"
             )
             message.add_body(alert.message_template, html=False)
             email_client.send_email(
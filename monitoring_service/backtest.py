@@ -0,0 +1,170 @@
+"""Backtest of candidate monitoring rules against the archived forecasts
+
+Each archived snapshot stands for an evaluation at the time it was fetched. The
+candidate's metric value is computed for all snapshots in one vectorized reduction,
+and any number of thresholds is then compared against those values at once, so a
+threshold sweep costs about the same as a single threshold.
+
+Fire counts are per archived forecast, not per monitoring run: runs served from the
+weather cache archive nothing, and neither does a refetch of an unchanged forecast.
+
+    python -m monitoring_service.backtest rule.json --threshold 25 --threshold 30
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from database.models.monitoring_rules import MonitoringRule, MonitoringRuleCreate
+from monitoring_service.evaluation import create_data_provider
+from monitoring_service.flow import compute_metric_values, crosses_threshold, monitoring_request
+from monitoring_service.forecast_archive import ForecastSnapshot
+from monitoring_service.rule_registry import CompiledRule, compile_rule, OPERATOR_CODES, MODE_CODES
+from monitoring_service.weather_client import EDRWeatherClient, WeatherQuery
+
+# snapshots of the queries of one metric fetched this close together belong to the same run
+_ALIGNMENT_TOLERANCE = np.timedelta64(60, "s")
+
+_DISTRIBUTION_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class BacktestResult(NamedTuple):
+    thresholds: np.ndarray
+    # (snapshot,) fetch times of the replayed snapshots and the metric values, NaN without data
+    evaluated_at: np.ndarray
+    metric_values: np.ndarray
+    # (threshold, snapshot) whether the rule would have fired on each archived forecast
+    fired: np.ndarray
+
+    @property
+    def fire_counts(self) -> np.ndarray:
+        return self.fired.sum(axis=1)
+
+    def distribution(self, bins: int = 20) -> dict[str, Any]:
+        values = self.metric_values[~np.isnan(self.metric_values)]
+        if len(values) == 0:
+            return {"count": 0}
+        counts, edges = np.histogram(values, bins=bins)
+        return {
+            "count": len(values),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+            "percentiles": dict(zip(
+                _DISTRIBUTION_PERCENTILES,
+                np.percentile(values, _DISTRIBUTION_PERCENTILES).tolist(),
+            )),
+            "histogram_counts": counts.tolist(),
+            "histogram_edges": edges.tolist(),
+        }
+
+
+class _ReplayWeatherClient(EDRWeatherClient):
+    """Serves the series of the current snapshots instead of querying the weather server"""
+
+    def __init__(self):
+        self.snapshots: dict[WeatherQuery, ForecastSnapshot] = {}
+
+    def fetch_series(self, query: WeatherQuery, *, dtime: datetime | None = None) -> tuple[np.ndarray, np.ndarray]:
+        snapshot = self.snapshots[query]
+        return snapshot.times, snapshot.data
+
+
+def compile_candidate(rule: MonitoringRuleCreate) -> CompiledRule:
+    return compile_rule(MonitoringRule.from_orm(rule))
+
+
+def align_snapshots(archives: list[list[ForecastSnapshot]]) -> list[list[ForecastSnapshot]]:
+    """Snapshots of every query fetched by the same run
+
+    For each snapshot of the first query, the latest snapshot of each other query
+    fetched until then. Snapshots without a counterpart of every query are skipped.
+    """
+    reference, *others = archives
+    others_fetched_at = [
+        np.array([snapshot.fetched_at for snapshot in archive], dtype="datetime64[s]")
+        for archive in others
+    ]
+
+    aligned = []
+    for snapshot in reference:
+        until = np.datetime64(snapshot.fetched_at, "s") + _ALIGNMENT_TOLERANCE
+        group = [snapshot]
+        for archive, fetched_at in zip(others, others_fetched_at):
+            index = np.searchsorted(fetched_at, until, side="right") - 1
+            if index < 0:
+                break
+            group.append(archive[index])
+        else:
+            aligned.append(group)
+    return aligned
+
+
+def backtest_rule(
+    rule: CompiledRule,
+    thresholds: list[float] | None = None,
+    time_from: datetime | None = None,
+    time_to: datetime | None = None,
+) -> BacktestResult:
+    """Replay the rule against the snapshots fetched within the range, for each of the thresholds"""
+    thresholds = np.asarray(thresholds if thresholds else [rule.value], dtype=np.float64)
+
+    weather_client = _ReplayWeatherClient()
+    provider = type(create_data_provider(rule.metric))(weather_client)
+    # the time interval only matters to the windows, which start at each snapshot
+    request = monitoring_request(rule.area, (time_from or datetime.min, time_to or datetime.max))
+    queries = provider.queries(**request)
+    snapshot_groups = align_snapshots(
+        [weather_client.archived_series(query, time_from, time_to) for query in queries]
+    )
+
+    evaluated_at = np.array([group[0].fetched_at for group in snapshot_groups], dtype="datetime64[s]")
+    window_ends = evaluated_at + np.timedelta64(int(rule.window_hours * 3600), "s")
+
+    # (1, time, area) values and (1, time) window masks of every snapshot
+    windows = []
+    for group, window_end in zip(snapshot_groups, window_ends):
+        weather_client.snapshots = dict(zip(queries, group))
+        times, data = provider.fetch_series(**request)
+        windows.append(provider.window_values(times, data, group[0].fetched_at, window_end[None]))
+
+    operators = np.full(len(windows), OPERATOR_CODES[rule.logical_operator], dtype=np.int8)
+    modes = np.full(len(windows), MODE_CODES[rule.evaluation_mode], dtype=np.int8)
+    metric_values = np.full(len(windows), np.nan)
+
+    # forecasts of different lengths are padded, areas of different sizes reduced separately
+    by_area_shape = defaultdict(list)
+    for index, (values, _) in enumerate(windows):
+        by_area_shape[values.shape[2:]].append(index)
+
+    for area_shape, indices in by_area_shape.items():
+        length = max(windows[index][1].shape[1] for index in indices)
+        values = np.zeros((len(indices), length) + area_shape)
+        in_window = np.zeros((len(indices), length), dtype=bool)
+        for row, index in enumerate(indices):
+            snapshot_values, snapshot_in_window = windows[index]
+            values[row, :snapshot_values.shape[1]] = snapshot_values[0]
+            in_window[row, :snapshot_in_window.shape[1]] = snapshot_in_window[0]
+        metric_values[indices] = compute_metric_values(values, in_window, modes[indices], operators[indices])
+
+    fired = crosses_threshold(operators[None, :], metric_values[None, :], thresholds[:, None])
+    return BacktestResult(thresholds, evaluated_at, metric_values, fired)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest a monitoring rule against the archived forecasts")
+    parser.add_argument("rule", help="JSON file with the rule as posted to /monitoring-rules/")
+    parser.add_argument("--threshold", type=float, action="append", help="threshold(s) to try instead of the rule's")
+    parser.add_argument("--from", dest="time_from", type=datetime.fromisoformat)
+    parser.add_argument("--to", dest="time_to", type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    candidate = compile_candidate(MonitoringRuleCreate.parse_file(args.rule))
+    result = backtest_rule(candidate, args.threshold, args.time_from, args.time_to)
+
+    print(f"Replayed {len(result.evaluated_at)} archived forecasts")
+    for threshold, fire_count in zip(result.thresholds, result.fire_counts):
+        print(f"{candidate.logical_operator.value} {threshold:g}: fired {fire_count} times")
+    print(result.distribution())
@@ -6,8 +6,7 @@ from typing import Literal, Any
 import numpy as np
 
 from database.models.monitoring_rules import MetricType
-from monitoring_service.weather_client import EDRWeatherClient
-
+from monitoring_service.weather_client import EDRWeatherClient, WeatherQuery
 
 
 class MetricDataProvider(ABC):
@@ -16,40 +15,81 @@ class MetricDataProvider(ABC):
         self._weather_client = weather_client
 
     @abstractmethod
-    def fetch_data(
+    def queries(
         self,
         *,
         lat: Decimal,
         long: Decimal,
-        dtime: datetime | None = None,
         query_type: Literal["radius"] | Literal["position"] = "radius",
         query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
-    ) -> np.ndarray:
-        ...
+    ) -> list[WeatherQuery]:
+        """Weather server queries needed to compute the metric"""
+
+    @abstractmethod
+    def fetch_series(
+        self,
+        *,
+        lat: Decimal,
+        long: Decimal,
+        query_type: Literal["radius"] | Literal["position"] = "radius",
+        query_params: dict[str, Any] | None = None,
+        time_interval: tuple[datetime, datetime] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Forecast times and the (time, area) metric values"""
+
+    def window_values(
+        self,
+        times: np.ndarray,
+        data: np.ndarray,
+        time_from: datetime,
+        window_ends: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Values to evaluate for each of the windows starting at `time_from`
+
+        Returns the (window, time, area) values and a (window, time) mask of the
+        entries that belong to each window.
+        """
+        in_window = (
+            (times >= np.datetime64(time_from, "s"))[None, :]
+            & (times[None, :] <= window_ends[:, None])
+        )
+        return data[None, ...], in_window
 
 
 class TemperatureDataProvider(MetricDataProvider):
-    def fetch_data(
+    def queries(
         self,
         *,
         lat: Decimal,
         long: Decimal,
-        dtime: datetime | None = None,
         query_type: Literal["radius"] | Literal["position"] = "radius",
         query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
-    ) -> np.ndarray:
-        data = self._weather_client.fetch_data(
-            parameter_name="temperature",
-            lat=lat,
-            long=long,
-            collection="height-above-ground",
-            query_type=query_type,
-            query_params=query_params,
-            time_interval=time_interval,
-        )
-        return self._kelvin_2_celsius(data)
+    ) -> list[WeatherQuery]:
+        return [
+            WeatherQuery.create(
+                parameter_name="temperature",
+                collection="height-above-ground",
+                lat=lat,
+                long=long,
+                query_type=query_type,
+                query_params=query_params,
+            )
+        ]
+
+    def fetch_series(
+        self,
+        *,
+        lat: Decimal,
+        long: Decimal,
+        query_type: Literal["radius"] | Literal["position"] = "radius",
+        query_params: dict[str, Any] | None = None,
+        time_interval: tuple[datetime, datetime] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        [query] = self.queries(lat=lat, long=long, query_type=query_type, query_params=query_params)
+        times, data = self._weather_client.fetch_series(query)
+        return times, self._kelvin_2_celsius(data)
 
     @staticmethod
     def _kelvin_2_celsius(k: np.ndarray):
@@ -57,102 +97,135 @@ class TemperatureDataProvider(MetricDataProvider):
 
 
 class PrecipitationDataProvider(MetricDataProvider):
-    # 1 kg/m² = 1 mm
-    TOTAL_ACC_PRECIPITATION_COLLECTION = [
-        # "pressure_gnd-surf": "single-layer",  # (Pa)
-        # Total precipitation - Ground surface - Accumulation 0h
-        # "total-precipitation_gnd-surf_stat": "single-layer",  # kg/m²"
-        ("total-precipitation_gnd-surf_stat:acc/PT0S", "single-layer_2",),
-        ("total-precipitation_gnd-surf_stat:acc/PT1H", "single-layer_3",),
-        ("total-precipitation_gnd-surf_stat:acc/PT2H", "single-layer_4",),
-        ("total-precipitation_gnd-surf_stat:acc/PT3H", "single-layer_5",),
-        ("total-precipitation_gnd-surf_stat:acc/PT4H", "single-layer_6",),
-        ("total-precipitation_gnd-surf_stat:acc/PT5H", "single-layer_7",),
-        ("total-precipitation_gnd-surf_stat:acc/PT6H", "single-layer_8"),
-    ]
-
-    def fetch_data(
+    """Total precipitation (1 kg/m² = 1 mm) within the rule time window
+
+    Only the hourly accumulation is fetched, totals for windows of any length are
+    derived from its cumulative sum, so rules over the same area share one fetch
+    whatever their windows are.
+    """
+    # Total precipitation - Ground surface - Accumulation over the previous hour
+    HOURLY_ACC_PRECIPITATION_COLLECTION = ("total-precipitation_gnd-surf_stat:acc/PT1H", "single-layer_3")
+
+    def queries(
         self,
         *,
         lat: Decimal,
         long: Decimal,
-        dtime: datetime | None = None,
         query_type: Literal["radius"] | Literal["position"] = "radius",
         query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
-    ) -> np.ndarray:
-
-        time_delta = time_interval[1] - time_interval[0]
-
-        hours = time_delta.seconds // 3600
-        # we can look at most 6 hours
-        hours = min(6, int(hours))
+    ) -> list[WeatherQuery]:
+        parameter_name, collection = self.HOURLY_ACC_PRECIPITATION_COLLECTION
+        return [
+            WeatherQuery.create(
+                parameter_name=parameter_name,
+                collection=collection,
+                lat=lat,
+                long=long,
+                query_type=query_type,
+                query_params=query_params,
+            )
+        ]
+
+    def fetch_series(
+        self,
+        *,
+        lat: Decimal,
+        long: Decimal,
+        query_type: Literal["radius"] | Literal["position"] = "radius",
+        query_params: dict[str, Any] | None = None,
+        time_interval: tuple[datetime, datetime] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        [query] = self.queries(lat=lat, long=long, query_type=query_type, query_params=query_params)
+        return self._weather_client.fetch_series(query)
 
-        parameter_name, collection = self.TOTAL_ACC_PRECIPITATION_COLLECTION[hours]
+    def window_values(
+        self,
+        times: np.ndarray,
+        data: np.ndarray,
+        time_from: datetime,
+        window_ends: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # the value at `t` is the accumulation over (t - 1h, t]
+        cumulative = np.concatenate([np.zeros((1,) + data.shape[1:]), np.cumsum(data, axis=0)])
+        start = np.searchsorted(times, np.datetime64(time_from, "s"), side="right")
+        ends = np.searchsorted(times, window_ends, side="right")
 
-        return self._weather_client.fetch_data(
-            parameter_name=parameter_name,
-            lat=lat,
-            long=long,
-            collection=collection,
-            query_type=query_type,
-            query_params=query_params,
-        )
+        # (window, area) totals
+        totals = cumulative[ends] - cumulative[start]
+        return totals[:, None, :], (ends > start)[:, None]
 
 
 class RelativeHumidityDataProvider(MetricDataProvider):
-    def fetch_data(
+    def queries(
         self,
         *,
         lat: Decimal,
         long: Decimal,
-        dtime: datetime | None = None,
         query_type: Literal["radius"] | Literal["position"] = "radius",
         query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
-    ) -> np.ndarray:
-        return self._weather_client.fetch_data(
-            parameter_name="precipitation",
-            lat=lat,
-            long=long,
-            collection="height-above-ground",
-            query_type=query_type,
-            query_params=query_params,
-            time_interval=time_interval,
-        )
+    ) -> list[WeatherQuery]:
+        return [
+            WeatherQuery.create(
+                parameter_name="precipitation",
+                collection="height-above-ground",
+                lat=lat,
+                long=long,
+                query_type=query_type,
+                query_params=query_params,
+            )
+        ]
+
+    def fetch_series(
+        self,
+        *,
+        lat: Decimal,
+        long: Decimal,
+        query_type: Literal["radius"] | Literal["position"] = "radius",
+        query_params: dict[str, Any] | None = None,
+        time_interval: tuple[datetime, datetime] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        [query] = self.queries(lat=lat, long=long, query_type=query_type, query_params=query_params)
+        return self._weather_client.fetch_series(query)
 
 
 class WindSpeedDataProvider(MetricDataProvider):
-    def fetch_data(
+    def queries(
         self,
         *,
         lat: Decimal,
         long: Decimal,
-        dtime: datetime | None = None,
         query_type: Literal["radius"] | Literal["position"] = "radius",
         query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
-    ) -> np.ndarray:
-        u_component = self._weather_client.fetch_data(
-            parameter_name="u-component-of-wind",
-            lat=lat,
-            long=long,
-            collection="height-above-ground_9",
-            query_type=query_type,
-            query_params=query_params,
-            time_interval=time_interval,
-        )
-        v_component = self._weather_client.fetch_data(
-            parameter_name="v-component-of-wind",
-            lat=lat,
-            long=long,
-            collection="height-above-ground_9",
-            query_type=query_type,
-            query_params=query_params,
-            time_interval=time_interval,
-        )
+    ) -> list[WeatherQuery]:
+        return [
+            WeatherQuery.create(
+                parameter_name=parameter_name,
+                collection="height-above-ground_9",
+                lat=lat,
+                long=long,
+                query_type=query_type,
+                query_params=query_params,
+            )
+            for parameter_name in ("u-component-of-wind", "v-component-of-wind")
+        ]
+
+    def fetch_series(
+        self,
+        *,
+        lat: Decimal,
+        long: Decimal,
+        query_type: Literal["radius"] | Literal["position"] = "radius",
+        query_params: dict[str, Any] | None = None,
+        time_interval: tuple[datetime, datetime] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        u_query, v_query = self.queries(lat=lat, long=long, query_type=query_type, query_params=query_params)
+        times, u_component = self._weather_client.fetch_series(u_query)
+        _, v_component = self._weather_client.fetch_series(v_query)
         wind_speed = np.sqrt(np.power(u_component, 2) + np.power(v_component, 2))
-        return wind_speed
+        return times, wind_speed
 
 
 def create_data_provider(metric: MetricType):
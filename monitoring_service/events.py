@@ -0,0 +1,42 @@
+"""In-process publish/subscribe of monitoring flow events"""
+import logging
+import threading
+from typing import Any, Callable, Literal, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class MonitoringEvent(NamedTuple):
+    type: Literal["trigger"] | Literal["run-finished"]
+    data: dict[str, Any]
+
+
+_Subscriber = Callable[[MonitoringEvent], None]
+
+_subscribers: list[_Subscriber] = []
+_lock = threading.Lock()
+
+
+def subscribe(subscriber: _Subscriber) -> Callable[[], None]:
+    """Call `subscriber` with every published event, returns a function unsubscribing it"""
+    with _lock:
+        _subscribers.append(subscriber)
+
+    def unsubscribe():
+        with _lock:
+            if subscriber in _subscribers:
+                _subscribers.remove(subscriber)
+
+    return unsubscribe
+
+
+def publish(event: MonitoringEvent) -> None:
+    with _lock:
+        subscribers = list(_subscribers)
+
+    for subscriber in subscribers:
+        try:
+            subscriber(event)
+        except Exception as exc:
+            # a broken subscriber must not break the monitoring run
+            logger.error(f"Event subscriber failed: {str(exc)}")
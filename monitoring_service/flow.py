@@ -1,93 +1,378 @@
+import heapq
+import itertools
 import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Any, Callable, NamedTuple
 
 import numpy as np
 from sqlmodel import Session, select
+from sqlalchemy import func, insert
 
+from configuration import Configuration
 from database.db import engine
-from database.models.alerts import AlertTrigger
-from database.models.monitoring_rules import EvaluationMode, \
-    LogicalOperator, MetricType
-from database.models.monitoring_runs import MonitoringRun
+from database.models.alerts import AlertTrigger, AlertTriggerRead
+from database.models.monitoring_rules import EvaluationMode, LogicalOperator, MetricType, \
+    PointRadiusArea, SpecificArea
+from database.models.deferred_rules import DeferredRule
+from database.models.monitoring_runs import MonitoringRun, MonitoringRunRead
+from monitoring_service import events, metrics, metric_history
 from monitoring_service.alerting import send_alert_notifications
-from monitoring_service.weather_client import NoDataException
-from datetime import datetime, timedelta
+from monitoring_service.evaluation import MetricDataProvider, create_data_provider
+from monitoring_service.rule_registry import CompiledRuleSet, rule_registry, OPERATOR_CODES, MODE_CODES, \
+    METRIC_CODES
+from monitoring_service.weather_client import EDRWeatherClient, NoDataException, WeatherServerError
 
-from database.models.monitoring_rules import MonitoringRule, AreaDefinition, TimeWindowDefinition
-from monitoring_service.evaluation import create_data_provider
+logger = logging.getLogger(__name__)
 
+_MINIMUM_OPERATORS = [OPERATOR_CODES[LogicalOperator.LTE], OPERATOR_CODES[LogicalOperator.LT]]
 
-def evaluate_monitoring_rule(rule: MonitoringRule, data: np.ndarray) -> AlertTrigger | None:
 
-    if rule.evaluation_mode == EvaluationMode.SINGLE_VALUE:
-        # we are looking for extremal values, either min of max based on logic operator
-        if rule.logical_operator in [LogicalOperator.LTE, LogicalOperator.LT]:
-            # data = data.min(axis=1, initial=np.inf)
-            metric_value = data.min(initial=np.inf)
+def compute_metric_values(
+    values: np.ndarray,
+    in_window: np.ndarray,
+    modes: np.ndarray,
+    operators: np.ndarray,
+) -> np.ndarray:
+    """Reduce the (window, time, area) values of each window to the value compared with the threshold
 
-        else:
-            # data = data.max(axis=1, initial=-np.inf)
-            metric_value = data.max(initial=-np.inf)
+    NaN marks windows without any data.
+    """
+    mask = np.broadcast_to(in_window[:, :, None], np.broadcast_shapes(values.shape, in_window.shape + (1,)))
+    axes = (1, 2)
 
-    elif rule.evaluation_mode == EvaluationMode.AVERAGE_VALUE:
-        # average the value across all measurements in the area
-        metric_value = data.mean()
+    # we are looking for extremal values, either min of max based on logic operator
+    minimum = np.where(mask, values, np.inf).min(axis=axes)
+    maximum = np.where(mask, values, -np.inf).max(axis=axes)
+    single_value = np.where(np.isin(operators, _MINIMUM_OPERATORS), minimum, maximum)
 
-    else:
-        raise ValueError(f"Unknown evaluation mode {rule.evaluation_mode}")
+    # average the value across all measurements in the area
+    count = mask.sum(axis=axes)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average_value = np.where(mask, values, 0).sum(axis=axes) / count
 
-    reference_value = rule.value
+    metric_values = np.where(modes == MODE_CODES[EvaluationMode.SINGLE_VALUE], single_value, average_value)
+    metric_values[count == 0] = np.nan
+    return metric_values
 
-    alert_triggered = (
-        rule.logical_operator == LogicalOperator.LTE and metric_value <= reference_value
-        or rule.logical_operator == LogicalOperator.LT and metric_value < reference_value
-        or rule.logical_operator == LogicalOperator.GTE and metric_value >= reference_value
-        or rule.logical_operator == LogicalOperator.GT and metric_value > reference_value
-    )
 
-    if alert_triggered:
-        return AlertTrigger(
-            monitoring_rule=rule,
-            triggered_at=datetime.now(),
-            reference_value=reference_value,
-            actual_value=metric_value,
-        )
-
-    return None
-
-
-logger = logging.getLogger(__name__)
+def evaluate_monitoring_rules(rules: CompiledRuleSet, metric_values: np.ndarray) -> np.ndarray:
+    """Mask of the rules whose metric value crosses the threshold"""
+    return crosses_threshold(rules.operators, metric_values, rules.thresholds)
 
 
-def dispatch_monitoring_request(rule: MonitoringRule) -> np.ndarray:
-    """Fetch the weather data based on rule definition"""
+def crosses_threshold(operators: np.ndarray, metric_values: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """Element-wise comparison of the values with the thresholds, the arguments broadcast"""
+    with np.errstate(invalid="ignore"):
+        return (
+            (operators == OPERATOR_CODES[LogicalOperator.LTE]) & (metric_values <= thresholds)
+            | (operators == OPERATOR_CODES[LogicalOperator.LT]) & (metric_values < thresholds)
+            | (operators == OPERATOR_CODES[LogicalOperator.GTE]) & (metric_values >= thresholds)
+            | (operators == OPERATOR_CODES[LogicalOperator.GT]) & (metric_values > thresholds)
+        )
 
-    area_definition = AreaDefinition.parse_obj(rule.area_definition).__root__
-    time_window_definition = TimeWindowDefinition.parse_obj(rule.time_window)
 
-    time_from = datetime.now()
-    timedelta_unit = "days" if time_window_definition.time_unit == "DAY" else "hours"
-    time_to = time_from + timedelta(**{timedelta_unit: time_window_definition.value})
+def monitoring_request(
+    area: PointRadiusArea | SpecificArea,
+    time_interval: tuple[datetime, datetime],
+) -> dict[str, Any]:
+    """Data provider arguments covering the area and time window"""
 
-    data_provider = create_data_provider(rule.metric)
+    if area.type == "POINT-RADIUS-AREA" and area.radius == 0:
+        # the forecast at the point itself, batched with other points (see `dispatch_monitoring_requests`)
+        return dict(
+            lat=area.lat,
+            long=area.long,
+            query_type="position",
+            time_interval=time_interval,
+        )
 
-    if area_definition.type == "POINT-RADIUS-AREA":
-        weather_data = data_provider.fetch_data(
-            lat=area_definition.lat,
-            long=area_definition.long,
+    elif area.type == "POINT-RADIUS-AREA":
+        return dict(
+            lat=area.lat,
+            long=area.long,
             query_type="radius",
             query_params={
-                "within": area_definition.radius,
-                "within-units": area_definition.radius_unit.lower()
+                "within": area.radius,
+                "within-units": area.radius_unit.lower()
             },
-            time_interval=(time_from, time_to),
-            # dtime=datetime.fromisoformat("2022-10-24T03:00:00"),
+            time_interval=time_interval,
         )
-        return weather_data
 
     else:
         raise NotImplementedError()
 
 
+class RequestGroup(NamedTuple):
+    """Rules answered by the same weather server queries"""
+
+    provider: MetricDataProvider
+    request: dict[str, Any]
+    indices: list[int]
+
+
+def group_monitoring_requests(rules: CompiledRuleSet, time_from: datetime) -> list[RequestGroup]:
+    providers: dict[MetricType, MetricDataProvider] = {}
+    groups: dict[tuple, RequestGroup] = {}
+
+    for index, rule in enumerate(rules.rules):
+        time_to = time_from + timedelta(hours=rule.window_hours)
+        try:
+            request = monitoring_request(rule.area, (time_from, time_to))
+        except NotImplementedError:
+            logger.warning(f"Area {rule.area.type} of rule {rule.title} is not supported")
+            continue
+
+        if rule.metric not in providers:
+            providers[rule.metric] = create_data_provider(rule.metric)
+        provider = providers[rule.metric]
+
+        key = (rule.metric, tuple(provider.queries(**request)))
+        if key not in groups:
+            groups[key] = RequestGroup(provider, request, [])
+        groups[key].indices.append(index)
+
+    return list(groups.values())
+
+
+def rule_priorities(rules: CompiledRuleSet, deferred_rule_ids: list[int]) -> np.ndarray:
+    """Evaluation order of the rules, higher first
+
+    Rules deferred by the previous run come first, then the rules of the more
+    severe metrics (`Configuration.RULE_METRIC_PRIORITIES`).
+    """
+    metric_priorities = np.zeros(len(METRIC_CODES), dtype=np.int64)
+    for metric, code in METRIC_CODES.items():
+        metric_priorities[code] = Configuration.RULE_METRIC_PRIORITIES.get(metric.value, 0)
+
+    priorities = metric_priorities[rules.metrics]
+    deferred = np.isin(rules.ids, np.asarray(deferred_rule_ids, dtype=np.int64))
+    return priorities + deferred * (metric_priorities.max() - metric_priorities.min() + 1)
+
+
+def run_deadline(monitoring_run: MonitoringRun) -> datetime | None:
+    if Configuration.RUN_DEADLINE_SECONDS <= 0:
+        return None
+    return monitoring_run.started_at + timedelta(seconds=Configuration.RUN_DEADLINE_SECONDS)
+
+
+def evaluate_request_group(rules: CompiledRuleSet, group: RequestGroup, time_from: datetime) -> np.ndarray:
+    """Metric values of the rules of the group, NaN if there is no data"""
+    indices = np.array(group.indices)
+    print(f"Evaluating {len(indices)} rule(s) of {type(group.provider).__name__}")
+
+    try:
+        times, data = group.provider.fetch_series(**group.request)
+    except (NoDataException, WeatherServerError) as exc:
+        print(str(exc))
+        return np.full(len(indices), np.nan)
+
+    window_ends = (
+        np.datetime64(time_from, "s")
+        + (rules.window_hours[indices] * 3600).astype("timedelta64[s]")
+    )
+    values, in_window = group.provider.window_values(times, data, time_from, window_ends)
+    return compute_metric_values(values, in_window, rules.modes[indices], rules.operators[indices])
+
+
+class DispatchResult(NamedTuple):
+    metric_values: np.ndarray
+    # rules left unevaluated at the deadline
+    deferred: np.ndarray
+
+
+_BATCH, _GROUP = 0, 1
+
+
+def dispatch_monitoring_requests(
+    rules: CompiledRuleSet,
+    time_from: datetime,
+    should_continue: Callable[[], bool] | None = None,
+    priorities: np.ndarray | None = None,
+    deadline: datetime | None = None,
+) -> DispatchResult:
+    """Fetch the weather data for all rules and compute their metric values
+
+    Rules sharing the same queries share a single fetch. Rules without data, or whose
+    fetch failed, get NaN. Point forecasts missing from the cache are fetched in
+    MULTIPOINT batches, each scheduled right before the first group needing it, and
+    the groups of a batch start once it is done, stale ones are served from the cache
+    and refreshed in batches in the background. The fetches run on
+    `Configuration.DISPATCH_WORKERS` threads in the order of the highest priority of
+    their rules. No fetch starts after the deadline or once `should_continue` says no;
+    the groups not started by then are still evaluated if their data is cached, the
+    rest and the groups still fetching are returned as deferred.
+    """
+    metric_values = np.full(len(rules), np.nan)
+    deferred = np.zeros(len(rules), dtype=bool)
+
+    groups = group_monitoring_requests(rules, time_from)
+    if priorities is not None:
+        groups.sort(key=lambda group: -priorities[group.indices].max())
+
+    weather_client = EDRWeatherClient()
+    group_queries = [group.provider.queries(**group.request) for group in groups]
+    position_queries = [query for queries in group_queries for query in queries if query.query_type == "position"]
+    # stale points are served as they are and refreshed in batches meanwhile
+    weather_client.revalidate_positions(position_queries)
+    batches = weather_client.position_batches(position_queries, refresh_stale=False)
+    batch_of = {query: index for index, batch in enumerate(batches) for query in batch}
+
+    # (rank, kind, index) heap of the tasks that can start, ranked by priority
+    ready: list[tuple[int, int, int]] = []
+    ranks = itertools.count()
+    group_ranks: list[int] = []
+    # groups waiting for their batches and the groups waiting for each batch
+    waiting_for: dict[int, set[int]] = {}
+    dependents: dict[int, list[int]] = {}
+    for group_index, queries in enumerate(group_queries):
+        needed = sorted({batch_of[query] for query in queries if query in batch_of})
+        for batch_index in needed:
+            if batch_index not in dependents:
+                heapq.heappush(ready, (next(ranks), _BATCH, batch_index))
+            dependents.setdefault(batch_index, []).append(group_index)
+        group_ranks.append(next(ranks))
+        if needed:
+            waiting_for[group_index] = set(needed)
+        else:
+            heapq.heappush(ready, (group_ranks[group_index], _GROUP, group_index))
+
+    def stopped() -> bool:
+        if deadline is not None and datetime.now() >= deadline:
+            return True
+        return should_continue is not None and not should_continue()
+
+    def record(group: RequestGroup, evaluate: Callable[[], np.ndarray]) -> None:
+        try:
+            metric_values[group.indices] = evaluate()
+        except Exception as exc:
+            # e.g. an unexpected payload, the other groups are still evaluated and recorded
+            logger.error(f"Failed to evaluate {len(group.indices)} rule(s) of "
+                         f"{type(group.provider).__name__}: {str(exc)}")
+            metrics.increment("flow.request_group_failures")
+
+    workers = Configuration.DISPATCH_WORKERS
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+    pending: dict[Future, tuple[int, int]] = {}
+    try:
+        while True:
+            # only as many tasks in flight as workers, so the priority order holds
+            while len(pending) < workers and ready and not stopped():
+                _, kind, index = heapq.heappop(ready)
+                if kind == _BATCH:
+                    future = executor.submit(weather_client.fetch_positions, batches[index])
+                else:
+                    future = executor.submit(evaluate_request_group, rules, groups[index], time_from)
+                pending[future] = (kind, index)
+
+            if not pending:
+                break
+            timeout = (deadline - datetime.now()).total_seconds() if deadline is not None else None
+            done, _ = wait(pending, timeout=max(timeout, 0) if timeout is not None else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, index = pending.pop(future)
+                if kind == _GROUP:
+                    record(groups[index], future.result)
+                    continue
+                # fetched or not, the points of the batch are now read from the cache or requested alone
+                for group_index in dependents[index]:
+                    waiting_for[group_index].discard(index)
+                    if not waiting_for[group_index]:
+                        del waiting_for[group_index]
+                        heapq.heappush(ready, (group_ranks[group_index], _GROUP, group_index))
+            if stopped():
+                break
+    finally:
+        # fetches running past the deadline still fill the cache for the next run
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # groups not started whose data is cached only take local reads, e.g. those of finished batches
+    not_started = sorted([index for _, kind, index in ready if kind == _GROUP] + list(waiting_for))
+    for group_index in not_started:
+        group = groups[group_index]
+        if all(weather_client.is_cached(query) for query in group_queries[group_index]):
+            record(group, lambda: evaluate_request_group(rules, group, time_from))
+        else:
+            deferred[group.indices] = True
+    for kind, index in pending.values():
+        if kind == _GROUP:
+            deferred[groups[index].indices] = True
+
+    if deferred.any():
+        logger.warning(f"Deferred {int(deferred.sum())} rule(s) to the next run")
+        metrics.increment("flow.rules_deferred", int(deferred.sum()))
+
+    return DispatchResult(metric_values, deferred)
+
+
+def record_triggers(
+    session: Session,
+    rules: CompiledRuleSet,
+    metric_values: np.ndarray,
+    triggered: np.ndarray,
+    monitoring_run_id: int,
+) -> list[events.MonitoringEvent]:
+    """Add the triggers of the triggered rules to the session, returns their events for after the commit"""
+    triggered_at = datetime.now()
+    triggers = [
+        AlertTrigger(
+            monitoring_rule_id=int(rules.ids[index]),
+            monitoring_run_id=monitoring_run_id,
+            triggered_at=triggered_at,
+            reference_value=float(rules.thresholds[index]),
+            actual_value=float(metric_values[index]),
+        )
+        for index in np.flatnonzero(triggered)
+    ]
+    for trigger in triggers:
+        logger.info(f"Monitoring rule triggered: {trigger}")
+    session.add_all(triggers)
+    session.flush()
+    return [
+        events.MonitoringEvent("trigger", AlertTriggerRead.from_orm(trigger).dict())
+        for trigger in triggers
+    ]
+
+
+def load_deferred_rule_ids(session: Session) -> list[int]:
+    """Rules deferred by the last finished run"""
+    last_run_id = select(func.max(MonitoringRun.id)).where(MonitoringRun.finished_at.is_not(None)).scalar_subquery()
+    return session.exec(
+        select(DeferredRule.monitoring_rule_id).where(DeferredRule.monitoring_run_id == last_run_id)
+    ).all()
+
+
+def record_deferred_rules(
+    session: Session,
+    rules: CompiledRuleSet,
+    deferred: np.ndarray,
+    monitoring_run_id: int,
+) -> None:
+    rule_ids = rules.ids[deferred].tolist()
+    if rule_ids:
+        session.execute(
+            insert(DeferredRule),
+            [dict(monitoring_run_id=monitoring_run_id, monitoring_rule_id=rule_id) for rule_id in rule_ids],
+        )
+
+
+def record_metric_values(
+    monitoring_run_id: int,
+    rules: CompiledRuleSet,
+    metric_values: np.ndarray,
+    deferred: np.ndarray,
+) -> None:
+    """Keep the metric values of all evaluated rules, triggered or not, in the history"""
+    evaluated = np.flatnonzero(~deferred)
+    try:
+        metric_history.append_metric_values(
+            monitoring_run_id, rules.ids[evaluated], metric_values[evaluated], rules.thresholds[evaluated]
+        )
+    except Exception as exc:
+        logger.error(f"Failed to write the metric history: {str(exc)}")
+
+
 def run_monitoring_flow() -> MonitoringRun:
     with Session(engine) as session:
 
@@ -96,33 +381,33 @@ def run_monitoring_flow() -> MonitoringRun:
         session.commit()
         session.refresh(monitoring_run)
 
-        stmt = select(MonitoringRule)
-        monitoring_rules = session.exec(stmt).all()
-        print(monitoring_rules)
-        triggers = []
-        for rule in monitoring_rules:
-            # evaluate the current rule
-            print(f"Evaluating rule {rule.title}")
+        rules = rule_registry.refresh(session)
+        print(f"Evaluating {len(rules)} monitoring rules")
 
-            try:
-                weather_data = dispatch_monitoring_request(rule)
-            except NoDataException as exc:
-                print(str(exc))
-                continue
+        metric_values, deferred = dispatch_monitoring_requests(
+            rules,
+            time_from=datetime.now(),
+            priorities=rule_priorities(rules, load_deferred_rule_ids(session)),
+            deadline=run_deadline(monitoring_run),
+        )
+        triggered = evaluate_monitoring_rules(rules, metric_values)
+        metrics.increment("flow.rules_without_data", int((np.isnan(metric_values) & ~deferred).sum()))
 
-            trigger = evaluate_monitoring_rule(rule, weather_data)
+        trigger_events = record_triggers(session, rules, metric_values, triggered, monitoring_run.id)
+        record_deferred_rules(session, rules, deferred, monitoring_run.id)
+        session.commit()
+        record_metric_values(monitoring_run.id, rules, metric_values, deferred)
 
-            if trigger is not None:
-                logger.info(f"Monitoring rule triggered: {trigger}")
-                trigger.monitoring_run = monitoring_run
-                session.add(trigger)
-                session.commit()
-                triggers.append(trigger)
+        for event in trigger_events:
+            events.publish(event)
 
-        send_alert_notifications(triggers)
+        send_alert_notifications([rules.rules[index] for index in np.flatnonzero(triggered)])
 
         monitoring_run.finished_at = datetime.now()
         session.add(monitoring_run)
         session.commit()
 
+        events.publish(events.MonitoringEvent("run-finished", MonitoringRunRead.from_orm(monitoring_run).dict()))
+        logger.info(f"Monitoring run metrics: {metrics.snapshot()}")
+
         return monitoring_run
@@ -0,0 +1,113 @@
+"""Archive of every forecast fetched from the weather server
+
+The weather cache keeps only the latest response of each query. Every fetched
+series is additionally stored as a compressed NumPy snapshot, so rules can be
+backtested against the forecasts the monitoring runs would have seen. A refetch
+returning the same forecast as the latest snapshot (the same times and values) is
+not stored again, and snapshots older than `FORECAST_ARCHIVE_RETENTION_DAYS` are pruned
+whenever the query is archived.
+"""
+import hashlib
+import logging
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from configuration import Configuration
+from monitoring_service import metrics
+from monitoring_service.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S"
+
+
+class ForecastSnapshot(NamedTuple):
+    fetched_at: datetime
+    times: np.ndarray
+    data: np.ndarray
+
+
+def snapshot_dir(archive_key: str) -> Path:
+    return Configuration.FORECAST_ARCHIVE_DIR / hashlib.sha1(archive_key.encode()).hexdigest()
+
+
+def _fetched_at(filename: Path) -> datetime:
+    return datetime.strptime(filename.name.split("-")[0], _TIMESTAMP_FORMAT)
+
+
+def _is_same_forecast(filename: Path, times: np.ndarray, data: np.ndarray) -> bool:
+    try:
+        with np.load(filename) as archived:
+            # a rerun of the model can keep the valid times and change the values
+            return np.array_equal(archived["times"], times) and np.array_equal(archived["data"], data)
+    except (OSError, ValueError):
+        # pruned meanwhile
+        return False
+
+
+def archive_snapshot(
+    archive_key: str,
+    times: np.ndarray,
+    data: np.ndarray,
+    fetched_at: datetime | None = None,
+) -> bool:
+    """Store the fetched series, False if the latest snapshot holds the same forecast"""
+    fetched_at = fetched_at or datetime.now()
+    directory = snapshot_dir(archive_key)
+    archived = sorted(directory.glob("*.npz"))
+
+    if archived and _is_same_forecast(archived[-1], times, data):
+        metrics.increment("forecast_archive.snapshots_unchanged")
+        return False
+
+    filename = directory / f"{fetched_at.strftime(_TIMESTAMP_FORMAT)}-{uuid.uuid4().hex[:8]}.npz"
+    atomic_write(filename, lambda f: np.savez_compressed(f, times=times, data=data), mode="wb")
+    metrics.increment("forecast_archive.snapshots_written")
+
+    prune_snapshots(archived, before=fetched_at - timedelta(days=Configuration.FORECAST_ARCHIVE_RETENTION_DAYS))
+    return True
+
+
+def prune_snapshots(filenames: list[Path], before: datetime) -> int:
+    """Delete the snapshots fetched before the given time, unless retention is disabled"""
+    if Configuration.FORECAST_ARCHIVE_RETENTION_DAYS <= 0:
+        return 0
+    pruned = 0
+    for filename in filenames:
+        if _fetched_at(filename) >= before:
+            continue
+        filename.unlink(missing_ok=True)
+        pruned += 1
+    if pruned:
+        metrics.increment("forecast_archive.snapshots_pruned", pruned)
+    return pruned
+
+
+def load_snapshots(
+    archive_key: str,
+    time_from: datetime | None = None,
+    time_to: datetime | None = None,
+) -> list[ForecastSnapshot]:
+    """Archived snapshots of the query fetched within the range, oldest first"""
+    directory = snapshot_dir(archive_key)
+    if not directory.is_dir():
+        return []
+
+    snapshots = []
+    for filename in sorted(directory.glob("*.npz")):
+        fetched_at = _fetched_at(filename)
+        if time_from is not None and fetched_at < time_from:
+            continue
+        if time_to is not None and fetched_at > time_to:
+            continue
+        try:
+            with np.load(filename) as archived:
+                snapshots.append(ForecastSnapshot(fetched_at, archived["times"], archived["data"]))
+        except FileNotFoundError:
+            # pruned since the listing
+            continue
+    return snapshots
@@ -0,0 +1,150 @@
+"""Append-only columnar history of the metric value of every evaluated rule
+
+Every run writes its values in bulk as one structured NumPy array (`HISTORY_DTYPE`)
+into the partition of the day it ran, `METRIC_HISTORY_DIR/<YYYY-MM-DD>/`. Partitions
+of past days are compacted into a single file sorted by time, so range queries over
+them read one memory-mapped file per day.
+"""
+import logging
+import os
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from configuration import Configuration
+from monitoring_service import metrics
+from monitoring_service.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DTYPE = np.dtype([
+    ("run_id", np.int64),
+    ("rule_id", np.int64),
+    ("evaluated_at", "datetime64[s]"),
+    ("value", np.float64),
+    ("threshold", np.float64),
+])
+
+_COMPACTED_PREFIX = "compacted-"
+_LOCK_NAME = ".compacting"
+
+
+def partition_dir(day: date) -> Path:
+    return Configuration.METRIC_HISTORY_DIR / day.isoformat()
+
+
+def _write_array(filename: Path, array: np.ndarray) -> None:
+    atomic_write(filename, lambda f: np.save(f, array, allow_pickle=False), mode="wb")
+
+
+def append_metric_values(
+    monitoring_run_id: int,
+    rule_ids: np.ndarray,
+    values: np.ndarray,
+    thresholds: np.ndarray,
+    evaluated_at: datetime | None = None,
+) -> Path:
+    """Store the metric values of one run (or shard of a run), NaN for rules without data"""
+    evaluated_at = evaluated_at or datetime.now()
+    chunk = np.empty(len(rule_ids), dtype=HISTORY_DTYPE)
+    chunk["run_id"] = monitoring_run_id
+    chunk["rule_id"] = rule_ids
+    chunk["evaluated_at"] = np.datetime64(evaluated_at, "s")
+    chunk["value"] = values
+    chunk["threshold"] = thresholds
+
+    directory = partition_dir(evaluated_at.date())
+    first_of_day = not directory.exists()
+    filename = directory / f"run-{monitoring_run_id}-{uuid.uuid4().hex[:8]}.npy"
+    _write_array(filename, chunk)
+    metrics.increment("metric_history.values_written", len(chunk))
+
+    if first_of_day:
+        # nothing writes into older partitions anymore, merge their chunks
+        compact_partitions(before=evaluated_at.date() - timedelta(days=1))
+    return filename
+
+
+def compact_partition(day: date) -> bool:
+    """Merge the chunks of a day into one file sorted by time, False if there was nothing to do"""
+    directory = partition_dir(day)
+    lock = directory / _LOCK_NAME
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        logger.info(f"Metric history of {day} is already being compacted")
+        return False
+    except FileNotFoundError:
+        return False
+
+    try:
+        chunks = sorted(directory.glob("*.npy"))
+        if len(chunks) <= 1:
+            return False
+
+        merged = np.concatenate([np.load(chunk) for chunk in chunks])
+        merged = merged[np.argsort(merged["evaluated_at"], kind="stable")]
+        _write_array(directory / f"{_COMPACTED_PREFIX}{uuid.uuid4().hex[:8]}.npy", merged)
+        # readers listing the partition right now may see some values twice, never none
+        for chunk in chunks:
+            chunk.unlink()
+        logger.info(f"Compacted {len(chunks)} metric history chunks of {day}")
+        return True
+    finally:
+        lock.unlink(missing_ok=True)
+
+
+def compact_partitions(before: date) -> int:
+    compacted = 0
+    if not Configuration.METRIC_HISTORY_DIR.exists():
+        return compacted
+    for directory in Configuration.METRIC_HISTORY_DIR.iterdir():
+        try:
+            day = date.fromisoformat(directory.name)
+        except ValueError:
+            continue
+        if day < before and compact_partition(day):
+            compacted += 1
+    return compacted
+
+
+def query_metric_values(
+    time_from: datetime,
+    time_to: datetime,
+    rule_ids: list[int] | None = None,
+) -> np.ndarray:
+    """Stored values evaluated within `[time_from, time_to)`, ordered by time"""
+    start, end = np.datetime64(time_from, "s"), np.datetime64(time_to, "s")
+    wanted = np.asarray(rule_ids, dtype=np.int64) if rule_ids is not None else None
+    parts = []
+
+    day = time_from.date()
+    while day <= time_to.date():
+        directory = partition_dir(day)
+        day += timedelta(days=1)
+        if not directory.is_dir():
+            continue
+
+        for filename in directory.glob("*.npy"):
+            try:
+                chunk = np.load(filename, mmap_mode="r")
+            except (FileNotFoundError, ValueError):
+                # compacted away since the listing
+                continue
+
+            times = chunk["evaluated_at"]
+            if filename.name.startswith(_COMPACTED_PREFIX):
+                # sorted by time, the range is found by binary search
+                chunk = chunk[np.searchsorted(times, start):np.searchsorted(times, end)]
+            else:
+                chunk = chunk[(times >= start) & (times < end)]
+            if wanted is not None:
+                chunk = chunk[np.isin(chunk["rule_id"], wanted)]
+            parts.append(np.asarray(chunk))
+
+    if not parts:
+        return np.empty(0, dtype=HISTORY_DTYPE)
+    result = np.concatenate(parts)
+    return result[np.argsort(result["evaluated_at"], kind="stable")]
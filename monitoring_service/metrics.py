@@ -0,0 +1,21 @@
+"""Process-wide counters for the monitoring service"""
+import threading
+from collections import Counter
+
+_counters: Counter[str] = Counter()
+_lock = threading.Lock()
+
+
+def increment(name: str, value: int = 1) -> None:
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot() -> dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
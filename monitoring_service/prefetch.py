@@ -0,0 +1,60 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from sqlmodel import Session
+
+from configuration import Configuration
+from database.db import engine
+from monitoring_service import metrics
+from monitoring_service.flow import group_monitoring_requests
+from monitoring_service.rule_registry import CompiledRuleSet, rule_registry
+from monitoring_service.weather_client import EDRWeatherClient, WeatherQuery, NoDataException, \
+    WeatherServerError
+
+logger = logging.getLogger(__name__)
+
+
+def derive_queries(rules: CompiledRuleSet) -> set[WeatherQuery]:
+    """Unique weather server queries needed to evaluate the given rules"""
+    queries = set()
+    for group in group_monitoring_requests(rules, time_from=datetime.now()):
+        queries.update(group.provider.queries(**group.request))
+    return queries
+
+
+def prefetch_queries(queries: set[WeatherQuery], max_workers: int | None = None) -> dict[str, int]:
+    """Concurrently fill the weather cache with fresh responses for the queries"""
+    weather_client = EDRWeatherClient()
+    summary = {"fetched": 0, "fresh": 0, "failed": 0}
+
+    # point forecasts go in batches, whatever a batch failed to fetch is retried one by one
+    batched = weather_client.prefetch_positions(queries)
+    summary["fetched"] += len(batched)
+
+    with ThreadPoolExecutor(max_workers=max_workers or Configuration.PREFETCH_WORKERS) as executor:
+        futures = {executor.submit(weather_client.prefetch, query): query for query in queries - batched}
+        for future in as_completed(futures):
+            try:
+                fetched = future.result()
+            except (NoDataException, WeatherServerError) as exc:
+                logger.warning(f"Failed to prefetch {futures[future]}: {str(exc)}")
+                summary["failed"] += 1
+                continue
+            summary["fetched" if fetched else "fresh"] += 1
+
+    for outcome, count in summary.items():
+        metrics.increment(f"prefetch.{outcome}", count)
+    return summary
+
+
+def run_prefetch() -> dict[str, int]:
+    """Warm up the weather cache for all monitoring rules"""
+    with Session(engine) as session:
+        monitoring_rules = rule_registry.refresh(session)
+        queries = derive_queries(monitoring_rules)
+
+    print(f"Prefetching {len(queries)} queries for {len(monitoring_rules)} rules")
+    summary = prefetch_queries(queries)
+    print(f"Prefetch finished: {summary}")
+    return summary
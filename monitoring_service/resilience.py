@@ -0,0 +1,133 @@
+"""Rate limiting, retries and circuit breaking for upstream calls"""
+import enum
+import logging
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+
+from monitoring_service import metrics
+
+_T = TypeVar("_T")
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Blocking token bucket allowing `rate` calls per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until it is available. Returns the time waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream after `failure_threshold` consecutive failures
+
+    After `reset_timeout` seconds a single trial call is let through (half-open);
+    its outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._state == CircuitState.OPEN:
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    metrics.increment(f"circuit_breaker.{self.name}.rejected")
+                    return False
+                self._transition(CircuitState.HALF_OPEN)
+
+            if self._state == CircuitState.HALF_OPEN:
+                if self._trial_in_flight:
+                    metrics.increment(f"circuit_breaker.{self.name}.rejected")
+                    return False
+                self._trial_in_flight = True
+
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            if self._state != CircuitState.CLOSED:
+                self._transition(CircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == CircuitState.HALF_OPEN or (
+                self._state == CircuitState.CLOSED and self._failures >= self._failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._transition(CircuitState.OPEN)
+
+    def _transition(self, state: CircuitState) -> None:
+        logger.warning(f"Circuit breaker {self.name}: {self._state.value} -> {state.value}")
+        metrics.increment(f"circuit_breaker.{self.name}.{self._state.value}_to_{state.value}")
+        self._state = state
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Exponential backoff with full jitter for the given (0-based) retry attempt"""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def call_with_retries(
+    func: Callable[[], _T],
+    *,
+    retry_on: tuple[type[Exception], ...],
+    max_retries: int,
+    backoff_base: float,
+    backoff_max: float,
+    metric_prefix: str,
+) -> _T:
+    """Call `func`, retrying with jittered backoff when it raises one of `retry_on`"""
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except retry_on as exc:
+            if attempt == max_retries:
+                metrics.increment(f"{metric_prefix}.retries_exhausted")
+                raise
+            delay = backoff_delay(attempt, backoff_base, backoff_max)
+            logger.warning(f"Attempt {attempt + 1} failed ({exc}), retrying in {delay:.2f} s")
+            metrics.increment(f"{metric_prefix}.retries")
+            time.sleep(delay)
@@ -0,0 +1,250 @@
+import json
+import logging
+import pickle
+import threading
+from dataclasses import dataclass
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from configuration import Configuration
+from database.models.alerts import AlertType
+from database.models.monitoring_rules import MonitoringRule, AreaDefinition, TimeWindowDefinition, \
+    PointRadiusArea, SpecificArea, MetricType, LogicalOperator, EvaluationMode
+from database.models.rule_changes import RuleChange
+from monitoring_service.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+OPERATOR_CODES = {operator: code for code, operator in enumerate(LogicalOperator)}
+MODE_CODES = {mode: code for code, mode in enumerate(EvaluationMode)}
+METRIC_CODES = {metric: code for code, metric in enumerate(MetricType)}
+
+# bumped whenever the compiled classes change, older snapshots are ignored
+_SNAPSHOT_FORMAT = 1
+
+
+class CompiledAlert(NamedTuple):
+    alert_type: AlertType
+    contact_info: str
+    message_template: str
+
+
+class CompiledRule(NamedTuple):
+    """Monitoring rule with its JSON columns parsed and its relations loaded"""
+
+    id: int
+    title: str
+    metric: MetricType
+    logical_operator: LogicalOperator
+    evaluation_mode: EvaluationMode
+    value: float
+    area: PointRadiusArea | SpecificArea
+    window_hours: float
+    alert_definitions: tuple[CompiledAlert, ...]
+
+
+def compile_rule(rule: MonitoringRule) -> CompiledRule:
+    time_window = TimeWindowDefinition.parse_obj(rule.time_window)
+    return CompiledRule(
+        id=rule.id,
+        title=rule.title,
+        metric=rule.metric,
+        logical_operator=rule.logical_operator,
+        evaluation_mode=EvaluationMode(rule.evaluation_mode),
+        value=rule.value,
+        area=AreaDefinition.parse_obj(rule.area_definition).__root__,
+        window_hours=time_window.value * (24 if time_window.time_unit == "DAY" else 1),
+        alert_definitions=tuple(
+            CompiledAlert(alert.alert_type, alert.contact_info, alert.message_template)
+            for alert in rule.alert_definitions
+        ),
+    )
+
+
+def area_key(area: PointRadiusArea | SpecificArea) -> str:
+    """Canonical form of an area, equal for equal areas in every process"""
+    return json.dumps(area.dict(), sort_keys=True, default=str)
+
+
+@dataclass(frozen=True)
+class CompiledRuleSet:
+    """Struct-of-arrays view of all monitoring rules, row `i` of every column is `rules[i]`"""
+
+    rules: list[CompiledRule]
+    ids: np.ndarray
+    thresholds: np.ndarray
+    operators: np.ndarray
+    modes: np.ndarray
+    metrics: np.ndarray
+    area_keys: np.ndarray
+    window_hours: np.ndarray
+    # distinct areas, indexed by `area_keys`
+    areas: list[PointRadiusArea | SpecificArea]
+
+    @classmethod
+    def from_rules(cls, rules: list[CompiledRule]) -> "CompiledRuleSet":
+        area_indices = {}
+        area_keys = []
+        areas = []
+        for rule in rules:
+            key = area_key(rule.area)
+            if key not in area_indices:
+                area_indices[key] = len(areas)
+                areas.append(rule.area)
+            area_keys.append(area_indices[key])
+
+        return cls(
+            rules=rules,
+            ids=np.array([rule.id for rule in rules], dtype=np.int64),
+            thresholds=np.array([rule.value for rule in rules], dtype=np.float64),
+            operators=np.array([OPERATOR_CODES[rule.logical_operator] for rule in rules], dtype=np.int8),
+            modes=np.array([MODE_CODES[rule.evaluation_mode] for rule in rules], dtype=np.int8),
+            metrics=np.array([METRIC_CODES[rule.metric] for rule in rules], dtype=np.int8),
+            area_keys=np.array(area_keys, dtype=np.int32),
+            window_hours=np.array([rule.window_hours for rule in rules], dtype=np.float64),
+            areas=areas,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def take(self, indices: np.ndarray) -> "CompiledRuleSet":
+        """Subset of the rules at the given indices, sharing the areas"""
+        return CompiledRuleSet(
+            rules=[self.rules[index] for index in indices],
+            ids=self.ids[indices],
+            thresholds=self.thresholds[indices],
+            operators=self.operators[indices],
+            modes=self.modes[indices],
+            metrics=self.metrics[indices],
+            area_keys=self.area_keys[indices],
+            window_hours=self.window_hours[indices],
+            areas=self.areas,
+        )
+
+
+class RuleRegistry:
+    """Compiled monitoring rules kept in memory between runs
+
+    Every write to a rule or its alert definitions appends to the `RuleChange` log
+    (see `database.models.rule_changes`), so a refresh only recompiles the rules
+    changed since the last one, whichever process wrote them. The compiled rules are
+    also stored in `Configuration.RULE_REGISTRY_SNAPSHOT_FILE` with their version, so
+    a new process, e.g. every `runner.py` run, starts from there instead of loading and
+    parsing all rules.
+    """
+
+    def __init__(self):
+        self._rules: dict[int, CompiledRule] = {}
+        self._version: int | None = None
+        self._compiled: CompiledRuleSet | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int | None:
+        return self._version
+
+    def refresh(self, session: Session) -> CompiledRuleSet:
+        with self._lock:
+            # read the version first, changes made meanwhile are picked up next time
+            version = session.exec(select(func.max(RuleChange.id))).one() or 0
+
+            restored = self._version is None and self._restore_snapshot(session, version)
+
+            if self._version is None:
+                self._rules = {rule.id: rule for rule in self._load(session)}
+                self._compiled = None
+                logger.info(f"Compiled {len(self._rules)} monitoring rules")
+
+            elif version != self._version:
+                changed_ids = set(session.exec(
+                    select(RuleChange.monitoring_rule_id).where(RuleChange.id > self._version)
+                ).all())
+                for rule_id in changed_ids:
+                    self._rules.pop(rule_id, None)
+                for rule in self._load(session, changed_ids):
+                    self._rules[rule.id] = rule
+                self._compiled = None
+                logger.info(f"Recompiled {len(changed_ids)} changed monitoring rules")
+
+            if restored and len(self._rules) != session.exec(select(func.count(MonitoringRule.id))).one():
+                # rules were deleted in bulk, bypassing the change log
+                logger.warning("Stored monitoring rules are out of date, compiling all of them")
+                self._rules = {rule.id: rule for rule in self._load(session)}
+                self._compiled = None
+
+            self._version = version
+            if self._compiled is None:
+                self._compiled = CompiledRuleSet.from_rules(
+                    sorted(self._rules.values(), key=lambda rule: rule.id)
+                )
+                self._store_snapshot(session)
+            return self._compiled
+
+    def invalidate(self) -> None:
+        """Drop everything, the next refresh recompiles all rules"""
+        with self._lock:
+            Configuration.RULE_REGISTRY_SNAPSHOT_FILE.unlink(missing_ok=True)
+            self._rules = {}
+            self._version = None
+            self._compiled = None
+
+    @staticmethod
+    def _database(session: Session) -> str:
+        return session.get_bind().url.render_as_string(hide_password=True)
+
+    def _restore_snapshot(self, session: Session, version: int) -> bool:
+        """Start from the rules stored by an earlier process, False if there are none of this database"""
+        filename = Configuration.RULE_REGISTRY_SNAPSHOT_FILE
+        try:
+            with filename.open("rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as exc:
+            logger.warning(f"Failed to read the stored monitoring rules: {str(exc)}")
+            return False
+
+        if (
+            snapshot.get("format") != _SNAPSHOT_FORMAT
+            or snapshot["database"] != self._database(session)
+            # the change log was reset, e.g. a new database at the same URL
+            or snapshot["version"] > version
+        ):
+            return False
+
+        self._compiled = snapshot["compiled"]
+        self._rules = {rule.id: rule for rule in self._compiled.rules}
+        self._version = snapshot["version"]
+        logger.info(f"Restored {len(self._rules)} compiled monitoring rules of version {self._version}")
+        return True
+
+    def _store_snapshot(self, session: Session) -> None:
+        snapshot = {
+            "format": _SNAPSHOT_FORMAT,
+            "database": self._database(session),
+            "version": self._version,
+            "compiled": self._compiled,
+        }
+        try:
+            atomic_write(
+                Configuration.RULE_REGISTRY_SNAPSHOT_FILE,
+                lambda f: pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL),
+                mode="wb",
+            )
+        except Exception as exc:
+            logger.error(f"Failed to store the compiled monitoring rules: {str(exc)}")
+
+    @staticmethod
+    def _load(session: Session, rule_ids: set[int] | None = None) -> list[CompiledRule]:
+        stmt = select(MonitoringRule).options(selectinload(MonitoringRule.alert_definitions))
+        if rule_ids is not None:
+            stmt = stmt.where(MonitoringRule.id.in_(rule_ids))
+        return [compile_rule(rule) for rule in session.exec(stmt).all()]
+
+
+rule_registry = RuleRegistry()
@@ -0,0 +1,266 @@
+"""Monitoring runs split into rule shards evaluated by several worker processes
+
+A sharded run creates one `RunLease` per shard. Workers, on this machine or others
+sharing the database, claim a shard with a conditional update, renew the lease from a
+heartbeat thread while fetching and complete it in the same transaction as writing
+its triggers, so every shard writes its triggers exactly once. Shards of crashed
+workers are claimed again once their lease expires. Rules are sharded by area so
+rules answered by the same weather server queries stay in one shard.
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, or_, update
+from sqlmodel import Session, select
+
+from configuration import Configuration
+from database.db import engine
+from database.models.monitoring_runs import MonitoringRun, MonitoringRunRead
+from database.models.run_leases import RunLease
+from monitoring_service import events, metrics
+from monitoring_service.alerting import send_alert_notifications
+from monitoring_service.flow import dispatch_monitoring_requests, evaluate_monitoring_rules, record_triggers, \
+    record_metric_values, record_deferred_rules, load_deferred_rule_ids, rule_priorities, run_deadline
+from monitoring_service.rule_registry import CompiledRuleSet, area_key, rule_registry
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def shard_rules(rules: CompiledRuleSet, shard: int, shard_count: int) -> CompiledRuleSet:
+    """Rules of one shard, assigned by a stable hash of their area"""
+    if len(rules) == 0:
+        return rules
+    area_shards = np.array(
+        [zlib.crc32(area_key(area).encode()) % shard_count for area in rules.areas], dtype=np.int64
+    )
+    return rules.take(np.flatnonzero(area_shards[rules.area_keys] == shard))
+
+
+def start_sharded_run(shard_count: int) -> MonitoringRun:
+    with Session(engine) as session:
+        monitoring_run = MonitoringRun(started_at=datetime.now())
+        session.add(monitoring_run)
+        session.flush()
+        session.add_all(
+            RunLease(monitoring_run_id=monitoring_run.id, shard=shard, shard_count=shard_count)
+            for shard in range(shard_count)
+        )
+        session.commit()
+        session.refresh(monitoring_run)
+        print(f"Started monitoring run {monitoring_run.id} with {shard_count} shards")
+        return monitoring_run
+
+
+def _claimable(now: datetime):
+    return RunLease.completed_at.is_(None), or_(RunLease.worker_id.is_(None), RunLease.expires_at < now)
+
+
+def claim_lease(session: Session, monitoring_run_id: int, worker_id: str) -> RunLease | None:
+    """Claim a shard which is unclaimed or whose lease expired, None if there is none"""
+    now = datetime.now()
+    candidates = session.exec(
+        select(RunLease.id, RunLease.worker_id)
+        .where(RunLease.monitoring_run_id == monitoring_run_id, *_claimable(now))
+        .order_by(RunLease.shard)
+    ).all()
+
+    for lease_id, previous_worker_id in candidates:
+        # the condition is checked again, only one of the competing workers gets the row
+        result = session.execute(
+            update(RunLease)
+            .where(RunLease.id == lease_id, *_claimable(now))
+            .values(worker_id=worker_id, expires_at=now + timedelta(seconds=Configuration.RUN_LEASE_TTL_SECONDS))
+        )
+        session.commit()
+        if result.rowcount == 1:
+            if previous_worker_id is not None:
+                logger.warning(f"Reclaimed expired lease {lease_id} of worker {previous_worker_id}")
+                metrics.increment("sharding.leases_reclaimed")
+            metrics.increment("sharding.leases_claimed")
+            return session.get(RunLease, lease_id)
+
+    return None
+
+
+def renew_lease(session: Session, lease_id: int, worker_id: str) -> bool:
+    """Extend the lease, False if another worker took it over meanwhile"""
+    result = session.execute(
+        update(RunLease)
+        .where(RunLease.id == lease_id, RunLease.worker_id == worker_id, RunLease.completed_at.is_(None))
+        .values(expires_at=datetime.now() + timedelta(seconds=Configuration.RUN_LEASE_TTL_SECONDS))
+    )
+    session.commit()
+    return result.rowcount == 1
+
+
+class LeaseHeartbeat:
+    """Renews a lease every third of its TTL from a background thread with its own session
+
+    The renewals do not depend on the evaluation getting back to them, so a fetch
+    stuck in retries cannot let the lease expire under a live worker.
+    """
+
+    def __init__(self, lease_id: int, worker_id: str):
+        self._lease_id = lease_id
+        self._worker_id = worker_id
+        self._held = True
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-{lease_id}-heartbeat", daemon=True)
+
+    @property
+    def held(self) -> bool:
+        return self._held
+
+    def _run(self) -> None:
+        while not self._stopped.wait(Configuration.RUN_LEASE_TTL_SECONDS / 3):
+            try:
+                with Session(engine) as session:
+                    self._held = renew_lease(session, self._lease_id, self._worker_id)
+            except Exception as exc:
+                # the lease may still be renewed in time on the next beat
+                logger.warning(f"Failed to renew lease {self._lease_id}: {str(exc)}")
+                continue
+            if not self._held:
+                return
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+def evaluate_shard(session: Session, lease: RunLease, monitoring_run: MonitoringRun) -> bool:
+    """Evaluate the rules of the leased shard, False if the lease was lost on the way"""
+    lease_id, worker_id = lease.id, lease.worker_id
+    rules = shard_rules(rule_registry.refresh(session), lease.shard, lease.shard_count)
+    print(f"Evaluating {len(rules)} monitoring rules of shard {lease.shard + 1}/{lease.shard_count}")
+
+    # every shard evaluates the same windows, so the workers share cached responses
+    with LeaseHeartbeat(lease_id, worker_id) as heartbeat:
+        metric_values, deferred = dispatch_monitoring_requests(
+            rules,
+            monitoring_run.started_at,
+            should_continue=lambda: heartbeat.held,
+            priorities=rule_priorities(rules, load_deferred_rule_ids(session)),
+            deadline=run_deadline(monitoring_run),
+        )
+    if not heartbeat.held:
+        logger.warning(f"Lost lease {lease_id}, dropping the results of shard {lease.shard}")
+        metrics.increment("sharding.leases_lost")
+        return False
+
+    triggered = evaluate_monitoring_rules(rules, metric_values)
+    metrics.increment("flow.rules_without_data", int((np.isnan(metric_values) & ~deferred).sum()))
+
+    completed = session.execute(
+        update(RunLease)
+        .where(RunLease.id == lease_id, RunLease.worker_id == worker_id, RunLease.completed_at.is_(None))
+        .values(completed_at=datetime.now())
+    )
+    if completed.rowcount != 1:
+        session.rollback()
+        logger.warning(f"Lease {lease_id} was taken over before completing shard {lease.shard}")
+        metrics.increment("sharding.leases_lost")
+        return False
+
+    trigger_events = record_triggers(session, rules, metric_values, triggered, monitoring_run.id)
+    record_deferred_rules(session, rules, deferred, monitoring_run.id)
+    session.commit()
+    record_metric_values(monitoring_run.id, rules, metric_values, deferred)
+
+    for event in trigger_events:
+        events.publish(event)
+    send_alert_notifications([rules.rules[index] for index in np.flatnonzero(triggered)])
+    return True
+
+
+def pending_shards(session: Session, monitoring_run_id: int) -> int:
+    return session.exec(
+        select(func.count(RunLease.id))
+        .where(RunLease.monitoring_run_id == monitoring_run_id, RunLease.completed_at.is_(None))
+    ).one()
+
+
+def finish_run_if_complete(session: Session, monitoring_run_id: int) -> bool:
+    """Mark the run finished once all its shards are, True for the one worker doing so"""
+    if pending_shards(session, monitoring_run_id):
+        return False
+
+    result = session.execute(
+        update(MonitoringRun)
+        .where(MonitoringRun.id == monitoring_run_id, MonitoringRun.finished_at.is_(None))
+        .values(finished_at=datetime.now())
+    )
+    session.commit()
+    if result.rowcount != 1:
+        return False
+
+    monitoring_run = session.get(MonitoringRun, monitoring_run_id)
+    session.refresh(monitoring_run)
+    events.publish(events.MonitoringEvent("run-finished", MonitoringRunRead.from_orm(monitoring_run).dict()))
+    return True
+
+
+def run_shard_worker(monitoring_run_id: int, worker_id: str | None = None) -> int:
+    """Evaluate shards of the run until all of them are completed, returns the number done here"""
+    worker_id = worker_id or default_worker_id()
+    completed = 0
+
+    with Session(engine) as session:
+        monitoring_run = session.get(MonitoringRun, monitoring_run_id)
+        if monitoring_run is None:
+            raise ValueError(f"Monitoring run {monitoring_run_id} does not exist")
+
+        while True:
+            lease = claim_lease(session, monitoring_run_id, worker_id)
+            if lease is None:
+                if not pending_shards(session, monitoring_run_id):
+                    finish_run_if_complete(session, monitoring_run_id)
+                    break
+                # the remaining shards are leased by others, take them over if they expire
+                time.sleep(Configuration.RUN_LEASE_POLL_SECONDS)
+                continue
+
+            if evaluate_shard(session, lease, monitoring_run):
+                completed += 1
+                finish_run_if_complete(session, monitoring_run_id)
+
+    logger.info(f"Worker {worker_id} completed {completed} shard(s), metrics: {metrics.snapshot()}")
+    return completed
+
+
+def _worker_process(monitoring_run_id: int) -> int:
+    from monitoring_service.utils import wait_for_revalidation
+
+    completed = run_shard_worker(monitoring_run_id)
+    wait_for_revalidation()
+    return completed
+
+
+def run_sharded_flow(shard_count: int, workers: int) -> MonitoringRun:
+    """Start a sharded run and evaluate it with local worker processes"""
+    monitoring_run = start_sharded_run(shard_count)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        completed = list(executor.map(_worker_process, [monitoring_run.id] * workers))
+    print(f"Shards completed per worker: {completed}")
+
+    with Session(engine) as session:
+        return session.get(MonitoringRun, monitoring_run.id)
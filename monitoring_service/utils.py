@@ -2,11 +2,16 @@ import errno
 import functools
 import json
 import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import timedelta
 from pathlib import Path
 from time import time
-from typing import Any, Callable, TypeVar
+from typing import IO, Any, Callable, TypeVar
 
 from configuration import Configuration
+from monitoring_service import metrics
 
 _DecoratedFunction = TypeVar("_DecoratedFunction", bound=Callable[..., Any])
 
@@ -25,7 +30,92 @@ def safe_open(filename: Path, **kwargs):
     return open(filename, **kwargs)
 
 
-def file_cache(resource_name: str, key: str) -> Callable[[_DecoratedFunction], _DecoratedFunction]:
+def atomic_write(filename: Path, writer: Callable[[IO], None], **kwargs) -> None:
+    """Write the file through `writer` into a temporary file replacing it when complete
+
+    Concurrent readers never see a partial file and concurrent writers of the same
+    file do not clash, the last one to finish wins. `kwargs` are passed to `open`.
+    """
+    tmp_filename = filename.with_name(f"{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with safe_open(tmp_filename, **kwargs) as f:
+            writer(f)
+        os.replace(tmp_filename, filename)
+    finally:
+        tmp_filename.unlink(missing_ok=True)
+
+
+def read_cached(resource_name: str, key: str) -> Any | None:
+    """Content cached by `file_cache` under the given key, if there is any"""
+    filename = Configuration.WEATHER_CACHE_DIR / resource_name / (key + ".txt")
+    try:
+        with filename.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+_revalidation_executor: ThreadPoolExecutor | None = None
+_revalidations: dict[Path, Future] = {}
+_revalidations_lock = threading.Lock()
+
+
+def revalidate(filenames: list[Path], refresh: Callable[[], None]) -> None:
+    """Run `refresh` of the cache entries in the background unless all of them are already being refreshed
+
+    One refresh may cover several entries, e.g. the points of a batched request.
+    """
+    global _revalidation_executor
+
+    with _revalidations_lock:
+        if all(filename in _revalidations for filename in filenames):
+            return
+        if _revalidation_executor is None:
+            _revalidation_executor = ThreadPoolExecutor(
+                max_workers=Configuration.WEATHER_CACHE_REVALIDATION_WORKERS,
+                thread_name_prefix="cache-revalidation",
+            )
+
+        def run():
+            try:
+                refresh()
+                metrics.increment("weather_cache.revalidations")
+            except Exception as exc:
+                metrics.increment("weather_cache.revalidation_failures")
+                names = filenames[0].name if len(filenames) == 1 else f"{len(filenames)} entries"
+                logger.warning(f"Failed to revalidate {names}: {str(exc)}")
+            finally:
+                with _revalidations_lock:
+                    for filename in filenames:
+                        if _revalidations.get(filename) is future:
+                            del _revalidations[filename]
+
+        # registered before `run` can finish, it waits for the lock
+        future = _revalidation_executor.submit(run)
+        for filename in filenames:
+            _revalidations[filename] = future
+
+
+def wait_for_revalidation(timeout: float | None = None) -> None:
+    """Block until the pending background cache refreshes are done"""
+    with _revalidations_lock:
+        pending = list(_revalidations.values())
+    wait(pending, timeout=timeout)
+
+
+def file_cache(
+    resource_name: str,
+    key: str,
+    max_age: timedelta | None = None,
+    stale_budget: timedelta = timedelta(0),
+) -> Callable[[_DecoratedFunction], _DecoratedFunction]:
+    """Cache the JSON result of the decorated function in a file
+
+    Entries younger than `max_age` are served as they are. Entries that are older, but
+    still within `max_age + stale_budget`, are served immediately while a refresh runs
+    in the background (stale-while-revalidate). Anything older is refetched before
+    returning. Without `max_age` the entries never expire.
+    """
 
     directory = Configuration.WEATHER_CACHE_DIR / resource_name
 
@@ -36,9 +126,7 @@ def file_cache(resource_name: str, key: str) -> Callable[[_DecoratedFunction], _
         return content
 
     def write(filename: Path, content: str):
-        with safe_open(filename, mode="w", encoding="utf-8") as f:
-            json.dump(content, f)
-
+        atomic_write(filename, lambda f: json.dump(content, f), mode="w", encoding="utf-8")
         logger.info(f"{resource_name} saved to cache")
 
     def decorator(func: _DecoratedFunction) -> _DecoratedFunction:
@@ -46,18 +134,63 @@ def file_cache(resource_name: str, key: str) -> Callable[[_DecoratedFunction], _
         def wrapper(*args, **kwargs):
             # key = '_'.join(str(arg) for arg in args) + '_' + '_'.join(f"{k}={v}" for k, v in kwargs.items())
             filename = directory / (key + ".txt")
-            if filename.exists():
-                content = read(filename)
 
-            else:
+            def fetch_and_write():
                 content = func(*args, **kwargs)
                 try:
                     write(filename, content)
                 except Exception as exc:
-                    filename.unlink(missing_ok=True)
                     logger.error(f"Failed to write to cache: {str(exc)}")
+                return content
+
+            try:
+                age = time() - filename.stat().st_mtime
+            except FileNotFoundError:
+                metrics.increment("weather_cache.misses")
+                return fetch_and_write()
+
+            if max_age is None or age <= max_age.total_seconds():
+                metrics.increment("weather_cache.hits")
+                return read(filename)
+
+            if age <= (max_age + stale_budget).total_seconds():
+                metrics.increment("weather_cache.stale_hits")
+                revalidate([filename], fetch_and_write)
+                return read(filename)
+
+            metrics.increment("weather_cache.expired")
+            return fetch_and_write()
+
+        def is_fresh() -> bool:
+            try:
+                age = time() - (directory / (key + ".txt")).stat().st_mtime
+            except FileNotFoundError:
+                return False
+            return max_age is None or age <= max_age.total_seconds()
+
+        def is_cached() -> bool:
+            """Whether a call is served from the cache, stale or not, without waiting for `func`"""
+            try:
+                age = time() - (directory / (key + ".txt")).stat().st_mtime
+            except FileNotFoundError:
+                return False
+            return max_age is None or age <= (max_age + stale_budget).total_seconds()
+
+        def refresh(*args, **kwargs):
+            """Fetch and cache the content regardless of what is cached"""
+            content = func(*args, **kwargs)
+            write(directory / (key + ".txt"), content)
             return content
 
+        def store(content):
+            """Cache content fetched by other means, e.g. as part of a batch"""
+            write(directory / (key + ".txt"), content)
+
+        wrapper.filename = directory / (key + ".txt")
+        wrapper.is_fresh = is_fresh
+        wrapper.is_cached = is_cached
+        wrapper.refresh = refresh
+        wrapper.store = store
         return wrapper
 
     return decorator
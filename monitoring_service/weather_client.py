@@ -1,16 +1,22 @@
+import functools
 import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from pprint import pprint
-from typing import Any, Literal
-import numpy as np
-import requests
+import threading
+from dataclasses import dataclass
+from collections import defaultdict
+from typing import Any, Iterable, Literal
+from urllib.parse import urlparse
 
-import tortilla
+import numpy as np
 
-from database.models.monitoring_rules import MetricType
-from monitoring_service.utils import file_cache
+from configuration import Configuration
+from monitoring_service import metrics
+from monitoring_service.forecast_archive import ForecastSnapshot, archive_snapshot, load_snapshots
+from monitoring_service.resilience import CircuitBreaker, TokenBucket, call_with_retries
+from monitoring_service.utils import file_cache, read_cached, revalidate
 
 logger = logging.getLogger(__name__)
 
@@ -23,53 +29,117 @@ class WeatherServerError(Exception):
     pass
 
 
+class UpstreamUnavailableError(WeatherServerError):
+    """The weather server timed out, was unreachable or responded with 5xx"""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Requests to the weather server are suspended after repeated failures"""
+
+
+_upstream_guards: dict[str, tuple[TokenBucket, CircuitBreaker]] = {}
+_upstream_guards_lock = threading.Lock()
+
+
+def upstream_guards(host: str) -> tuple[TokenBucket, CircuitBreaker]:
+    """Rate limiter and circuit breaker shared by all requests to the given host"""
+    with _upstream_guards_lock:
+        if host not in _upstream_guards:
+            _upstream_guards[host] = (
+                TokenBucket(
+                    rate=Configuration.EDR_RATE_LIMIT_PER_SECOND,
+                    capacity=Configuration.EDR_RATE_LIMIT_BURST,
+                ),
+                CircuitBreaker(
+                    name=host,
+                    failure_threshold=Configuration.EDR_CIRCUIT_FAILURE_THRESHOLD,
+                    reset_timeout=Configuration.EDR_CIRCUIT_RESET_SECONDS,
+                ),
+            )
+        return _upstream_guards[host]
+
+
+def filter_time_interval(
+    times: np.ndarray,
+    data: np.ndarray,
+    time_interval: tuple[datetime, datetime],
+) -> np.ndarray:
+    """Rows of the (time, ...) data falling into the time interval"""
+    in_time_interval = (
+        (times >= np.datetime64(time_interval[0], "s")) & (times <= np.datetime64(time_interval[1], "s"))
+    )
+
+    if not in_time_interval.any():
+        raise NoDataException(f"No data for given time interval {time_interval}")
+
+    return data[in_time_interval, ...]
+
+
+@dataclass(frozen=True)
+class WeatherQuery:
+    """A single EDR query; equal queries share one cache entry"""
+
+    parameter_name: str
+    collection: str
+    lat: Decimal
+    long: Decimal
+    query_type: Literal["radius"] | Literal["position"] = "radius"
+    query_params: tuple[tuple[str, Any], ...] = ()
+
+    @classmethod
+    def create(cls, *, query_params: dict[str, Any] | None = None, **kwargs) -> "WeatherQuery":
+        return cls(query_params=tuple((query_params or {}).items()), **kwargs)
+
+
 class EDRWeatherClient:
 
-    _BASE_URL = "https://climathon.iblsoft.com/data/icon-de/edr"
+    _BASE_URL = Configuration.EDR_BASE_URL
+
+    @functools.cached_property
+    def api(self):
+        import tortilla
 
-    def __init__(self):
-        self.api = tortilla.wrap(self._BASE_URL, debug=True)
+        return tortilla.wrap(self._BASE_URL, debug=True)
 
     def fetch_data(
         self,
+        query: WeatherQuery,
         *,
-        lat: Decimal,
-        long: Decimal,
         dtime: datetime | None = None,
-        parameter_name: str,
-        collection: str,
-        query_type: Literal["radius"] | Literal["position"] = "radius",
-        query_params: dict[str, Any] | None = None,
         time_interval: tuple[datetime, datetime] = None
     ) -> np.ndarray:
+        times, data = self.fetch_series(query, dtime=dtime)
 
-        params = {
-            "coords": f"POINT({long} {lat})",
-            # "z": 2,
-            "datetime": dtime.isoformat() if dtime else None,
-            "parameter-name": parameter_name,
-            "f": "CoverageJSON",
-        } | query_params
-
-        url = f"{self._BASE_URL}/collections/{collection}/{query_type}"
-        print(f"Requesting data from URL: {url}\nParameters: {params}")
-
-        @file_cache("icon-de", f"collections/{query_type}/{json.dumps(params)}")
-        def fetch():
-            response = requests.get(url, params=params)
-
-            if response.status_code == 204:
-                raise NoDataException(f"No data for {str(params)}")
-
-            resp_data = response.json()
-            if "code" in resp_data and resp_data["code"] != "200":
-                logger.error(str(resp_data))
-                raise WeatherServerError(f"Error server response: {str(resp_data)}")
-
-            return resp_data
+        # filter data from the desired interval
+        if time_interval is not None:
+            data = filter_time_interval(times, data, time_interval)
 
-        resp = fetch()
+        return data
 
+    def fetch_series(
+        self,
+        query: WeatherQuery,
+        *,
+        dtime: datetime | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Forecast times (datetime64) and the (time, area) values of the queried parameter"""
+        parameter_name = query.parameter_name
+
+        fetch = self._cached_fetch(query, dtime)
+        try:
+            resp = fetch()
+        except UpstreamUnavailableError as exc:
+            # fall back to the last snapshot we have for this query
+            resp = read_cached("icon-de", fetch.cache_key)
+            if resp is None:
+                raise
+            logger.warning(f"Serving cached snapshot, weather server unavailable: {str(exc)}")
+            metrics.increment("edr.snapshot_fallbacks")
+
+        return self._parse_series(resp, parameter_name)
+
+    @staticmethod
+    def _parse_series(resp: dict, parameter_name: str) -> tuple[np.ndarray, np.ndarray]:
         if resp["type"] == "Coverage":
             # single time slice
             ...
@@ -85,20 +155,268 @@ class EDRWeatherClient:
 
         # (time * area) -> (time, area)
         data = data.reshape(parameter_data["shape"])
+        if data.ndim == 1:
+            # a single position
+            data = data[:, None]
 
-        # filter data from the desired interval
-        if time_interval is not None:
-            in_time_interval = [
-                time_interval[0] <= datetime.fromisoformat(date_str.strip("Z")) <= time_interval[1]
-                for date_str in resp["domain"]["axes"]["t"]["values"]
+        times = np.array(
+            [date_str.strip("Z") for date_str in resp["domain"]["axes"]["t"]["values"]],
+            dtype="datetime64[s]",
+        )
+        return times, data
+
+    def position_batches(
+        self,
+        queries: Iterable[WeatherQuery],
+        refresh_stale: bool = True,
+    ) -> list[list[WeatherQuery]]:
+        """Position queries to fetch, split into batches of one MULTIPOINT request each
+
+        Queries whose cache entry is missing or expired are included, stale ones only
+        with `refresh_stale` (otherwise see `revalidate_positions`). Queries of other
+        types are ignored.
+        """
+        return self._batch_positions(
+            query for query in queries
+            if query.query_type == "position" and not self._cached_fetch(query).is_fresh()
+            and (refresh_stale or not self._cached_fetch(query).is_cached())
+        )
+
+    def revalidate_positions(self, queries: Iterable[WeatherQuery]) -> int:
+        """Refresh the stale cache entries of the position queries with batched requests in the background
+
+        The entries are registered as being refreshed right away, so reading them
+        meanwhile serves them as they are instead of refreshing each one on its own.
+        Returns the number of entries being refreshed.
+        """
+        batches = self._batch_positions(
+            query for query in queries
+            if query.query_type == "position" and self._cached_fetch(query).is_cached()
+            and not self._cached_fetch(query).is_fresh()
+        )
+        for batch in batches:
+            revalidate(
+                [self._cached_fetch(query).filename for query in batch],
+                functools.partial(self._fetch_positions, batch),
+            )
+        return sum(len(batch) for batch in batches)
+
+    @staticmethod
+    def _batch_positions(queries: Iterable[WeatherQuery]) -> list[list[WeatherQuery]]:
+        """Queries for the same parameter and collection go together, `EDR_POSITION_BATCH_SIZE`
+        at a time, the batches in the order of their first query"""
+        batches: dict[tuple, list[list[WeatherQuery]]] = defaultdict(list)
+        ordered = []
+        for query in dict.fromkeys(queries):
+            key = (query.collection, query.parameter_name, query.query_params)
+            if not batches[key] or len(batches[key][-1]) == Configuration.EDR_POSITION_BATCH_SIZE:
+                batches[key].append([])
+                ordered.append(batches[key][-1])
+            batches[key][-1].append(query)
+        return ordered
+
+    def fetch_positions(self, queries: list[WeatherQuery]) -> bool:
+        """Fetch the positions in one request and cache the response of each of them
+
+        Returns False if the request failed, the points are then requested one by one
+        when evaluated.
+        """
+        try:
+            self._fetch_positions(queries)
+        except Exception as exc:
+            logger.warning(f"Failed to fetch {len(queries)} positions: {str(exc)}")
+            metrics.increment("edr.position_batch_failures")
+            return False
+        return True
+
+    def _fetch_positions(self, queries: list[WeatherQuery]) -> None:
+        for query, resp in zip(queries, self._request_positions(queries)):
+            self._cached_fetch(query).store(resp)
+            if Configuration.FORECAST_ARCHIVE_ENABLED:
+                self._archive(query, resp)
+
+    def prefetch_positions(self, queries: Iterable[WeatherQuery]) -> set[WeatherQuery]:
+        """Fill the cache for position queries with batched MULTIPOINT requests
+
+        Every position query whose cache entry is not fresh is fetched, see
+        `position_batches`. Returns the queries fetched.
+        """
+        fetched = set()
+        for batch in self.position_batches(queries):
+            if self.fetch_positions(batch):
+                fetched.update(batch)
+        return fetched
+
+    def _request_positions(self, queries: list[WeatherQuery]) -> list[dict]:
+        """One request for all the positions, the response split into a coverage per position"""
+        url, params = self._request_params(queries[0])
+        params["coords"] = "MULTIPOINT(" + ", ".join(f"({query.long} {query.lat})" for query in queries) + ")"
+        print(f"Requesting {len(queries)} positions from URL: {url}")
+
+        resp = self._request(url, params)
+        metrics.increment("edr.position_batches")
+        metrics.increment("edr.positions_batched", len(queries))
+
+        parameter_name = queries[0].parameter_name
+        if resp["type"] == "CoverageCollection":
+            coverages = resp["coverages"]
+        else:
+            # a MultiPointSeries coverage, positions along the last axis in the requested order
+            _, data = self._parse_series(resp, parameter_name)
+            coverages = [
+                {
+                    "type": "Coverage",
+                    "domain": {
+                        "type": "Domain",
+                        "domainType": "PointSeries",
+                        "axes": {"t": resp["domain"]["axes"]["t"]},
+                    },
+                    "ranges": {
+                        parameter_name: {
+                            "type": "NdArray",
+                            "shape": [data.shape[0], 1],
+                            "values": data[:, index].tolist(),
+                        }
+                    },
+                }
+                for index in range(data.shape[1])
             ]
 
-            if not any(in_time_interval):
-                raise NoDataException(f"No data for given time interval {time_interval}")
+        if len(coverages) != len(queries):
+            raise WeatherServerError(f"Requested {len(queries)} positions, received {len(coverages)}")
+        return coverages
 
-            data = data[in_time_interval, ...]
+    def archived_series(
+        self,
+        query: WeatherQuery,
+        time_from: datetime | None = None,
+        time_to: datetime | None = None,
+    ) -> list[ForecastSnapshot]:
+        """Every archived forecast of the query fetched within the range, oldest first"""
+        return load_snapshots(self._archive_key(query), time_from, time_to)
+
+    def is_cached(self, query: WeatherQuery) -> bool:
+        """Whether the query is answered from the cache without waiting for the weather server"""
+        return self._cached_fetch(query).is_cached()
+
+    def prefetch(self, query: WeatherQuery) -> bool:
+        """Make sure the cache holds a fresh response for the query
+
+        Returns whether the weather server had to be queried.
+        """
+        fetch = self._cached_fetch(query)
+        if fetch.is_fresh():
+            return False
+        fetch.refresh()
+        return True
+
+    def _request_params(self, query: WeatherQuery, dtime: datetime | None = None) -> tuple[str, dict[str, Any]]:
+        params = {
+            "coords": f"POINT({query.long} {query.lat})",
+            # "z": 2,
+            "datetime": dtime.isoformat() if dtime else None,
+            "parameter-name": query.parameter_name,
+            "f": "CoverageJSON",
+        } | dict(query.query_params)
+
+        url = f"{self._BASE_URL}/collections/{query.collection}/{query.query_type}"
+        return url, params
+
+    @staticmethod
+    def _cache_key(query: WeatherQuery, params: dict[str, Any]) -> str:
+        return f"collections/{query.query_type}/{json.dumps(params)}"
+
+    def _archive_key(self, query: WeatherQuery) -> str:
+        _, params = self._request_params(query)
+        # the same coordinates written with a different number of decimals share the archive
+        params["coords"] = f"POINT({float(query.long)} {float(query.lat)})"
+        return self._cache_key(query, params)
+
+    def _cached_fetch(self, query: WeatherQuery, dtime: datetime | None = None):
+        url, params = self._request_params(query, dtime)
+        cache_key = self._cache_key(query, params)
+
+        @file_cache(
+            "icon-de",
+            cache_key,
+            max_age=timedelta(seconds=Configuration.WEATHER_CACHE_MAX_AGE_SECONDS),
+            stale_budget=timedelta(seconds=Configuration.WEATHER_CACHE_STALE_BUDGET_SECONDS),
+        )
+        def fetch():
+            print(f"Requesting data from URL: {url}\nParameters: {params}")
+            resp = self._request(url, params)
+            if Configuration.FORECAST_ARCHIVE_ENABLED and dtime is None:
+                self._archive(query, resp)
+            return resp
 
-        return data
+        fetch.cache_key = cache_key
+        return fetch
+
+    def _archive(self, query: WeatherQuery, resp: dict) -> None:
+        try:
+            times, data = self._parse_series(resp, query.parameter_name)
+            archive_snapshot(self._archive_key(query), times, data)
+        except Exception as exc:
+            logger.error(f"Failed to archive forecast: {str(exc)}")
+
+    @staticmethod
+    def _request(url: str, params: dict[str, Any]) -> dict:
+        # only cache misses pay for importing the HTTP stack
+        import requests
+
+        rate_limiter, circuit_breaker = upstream_guards(urlparse(url).netloc)
+
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError(f"Circuit open, not requesting {url}")
+
+        def attempt() -> requests.Response:
+            if rate_limiter.acquire() > 0:
+                metrics.increment("edr.rate_limited")
+            metrics.increment("edr.requests")
+            try:
+                response = requests.get(url, params=params, timeout=Configuration.EDR_TIMEOUT_SECONDS)
+            except requests.Timeout as exc:
+                metrics.increment("edr.timeouts")
+                raise UpstreamUnavailableError(f"Request to {url} timed out") from exc
+            except requests.ConnectionError as exc:
+                metrics.increment("edr.connection_errors")
+                raise UpstreamUnavailableError(f"Cannot connect to {url}: {str(exc)}") from exc
+            except requests.RequestException as exc:
+                # e.g. a connection dropped mid-body, anything else would leave a half-open trial hanging
+                metrics.increment("edr.request_errors")
+                raise UpstreamUnavailableError(f"Request to {url} failed: {str(exc)}") from exc
+
+            if response.status_code >= 500:
+                metrics.increment("edr.server_errors")
+                raise UpstreamUnavailableError(f"Weather server responded with {response.status_code}")
+            return response
+
+        try:
+            response = call_with_retries(
+                attempt,
+                retry_on=(UpstreamUnavailableError,),
+                max_retries=Configuration.EDR_MAX_RETRIES,
+                backoff_base=Configuration.EDR_BACKOFF_BASE_SECONDS,
+                backoff_max=Configuration.EDR_BACKOFF_MAX_SECONDS,
+                metric_prefix="edr",
+            )
+        except UpstreamUnavailableError:
+            circuit_breaker.record_failure()
+            raise
+        circuit_breaker.record_success()
+
+        if response.status_code == 204:
+            raise NoDataException(f"No data for {str(params)}")
+
+        try:
+            resp_data = response.json()
+        except ValueError as exc:
+            raise WeatherServerError(f"Weather server responded with invalid JSON: {str(exc)}") from exc
+        if "code" in resp_data and resp_data["code"] != "200":
+            logger.error(str(resp_data))
+            raise WeatherServerError(f"Error server response: {str(resp_data)}")
+
+        return resp_data
 
     def list_collections(self):
         @file_cache("icon-de", "collections")
@@ -119,13 +437,16 @@ if __name__ == "__main__":
     assert False
 
     resp = client.fetch_data(
-        lat=Decimal("48.163394"),
-        long=Decimal("17.124840"),
+        WeatherQuery.create(
+            parameter_name="relative-humidity",
+            collection="height-above-ground",
+            lat=Decimal("48.163394"),
+            long=Decimal("17.124840"),
+            query_type="radius",
+            query_params={
+                "within": 2,
+                "within-units": "km"
+            },
+        ),
         # dtime=datetime.fromisoformat("2022-10-24T03:00:00"),
-        metric=MetricType.RelativeHumidity,
-        query_type="radius",
-        query_params={
-            "within": 2,
-            "within-units": "km"
-        }
     )
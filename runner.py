@@ -1,7 +1,31 @@
+"""Run the monitoring flow
+
+    python runner.py                          # in this process
+    python runner.py --shards 8 --workers 4   # sharded over 4 local worker processes
+    python runner.py --join 42                # work on sharded run 42 started elsewhere
+"""
+import argparse
+
 from database.db import create_db_and_tables
-from monitoring_service.flow import run_monitoring_flow
+from monitoring_service.utils import wait_for_revalidation
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, help="split the rules into this many shards")
+    parser.add_argument("--workers", type=int, help="local worker processes for a sharded run")
+    parser.add_argument("--join", type=int, metavar="RUN_ID", help="evaluate shards of an existing run")
+    args = parser.parse_args()
+
     create_db_and_tables()
-    run_monitoring_flow()
+    if args.join is not None:
+        from monitoring_service.sharding import run_shard_worker
+        run_shard_worker(args.join)
+    elif args.shards:
+        from monitoring_service.sharding import run_sharded_flow
+        run_sharded_flow(args.shards, args.workers or args.shards)
+    else:
+        from monitoring_service.flow import run_monitoring_flow
+        run_monitoring_flow()
+    # let stale cache entries finish refreshing for the next run
+    wait_for_revalidation()
@@ -0,0 +1,7 @@
+from database.db import create_db_and_tables
+from monitoring_service.prefetch import run_prefetch
+
+
+if __name__ == "__main__":
+    create_db_and_tables()
+    run_prefetch()